@@ -0,0 +1,242 @@
+# benchmark.py
+# To be run on a computer (not the Pico)
+# Load-tests the device HTTP API: boots main.py on a virtual Pico in a child
+# process, drives a weighted mix of requests at increasing concurrency over
+# keep-alive connections, and reports throughput, latency percentiles and the
+# jitter of the firmware's 50 ms light-loop ticks. Results are saved as JSON
+# so runs can be compared over time.
+#
+# Usage:
+#   python src/benchmark.py --levels 1,4,8 --duration 5
+#   python src/benchmark.py --mix sensor=50,health=50 --out before.json
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import random
+import time
+
+import virtual_pico
+
+DEFAULT_MIX = "sensor=40,health=30,tone=10,melody=10,stop=10"
+LIGHT_LOOP_MS = 50
+
+# Request line + body for each mix entry
+REQUESTS = {
+    "sensor": ("GET", "/sensor", b""),
+    "health": ("GET", "/health", b""),
+    "status": ("GET", "/status", b""),
+    "tone": ("POST", "/tone", b'{"freq": 440, "ms": 100, "duty": 0.5}'),
+    "melody": (
+        "POST", "/melody",
+        b'{"notes": [{"freq": 523, "ms": 60}, {"freq": 659, "ms": 60}], "gap_ms": 10}',
+    ),
+    "stop": ("POST", "/stop", b""),
+}
+
+
+def encode_request(method, path, body):
+    return (
+        f"{method} {path} HTTP/1.1\r\nHost: bench\r\nContent-Length: {len(body)}\r\n\r\n"
+    ).encode("utf-8") + body
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of an unsorted list (None if empty)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[rank]
+
+
+def summarize(values):
+    return {
+        "count": len(values),
+        "p50": percentile(values, 50),
+        "p90": percentile(values, 90),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None,
+    }
+
+
+# --- Device side (child process) ---
+
+
+def serve(http_port, udp_port, conn, dual_core=False):
+    """Runs the firmware and answers 'ticks' requests with light-loop intervals."""
+    pico = virtual_pico.load_firmware(http_port, udp_port, quiet=True)
+    pico.DUAL_CORE = dual_core
+    ticks = []
+
+    # api_sound_active() is the first call of every light-loop iteration
+    sound_active = pico.api_sound_active
+
+    def timed_sound_active():
+        ticks.append(time.monotonic() * 1000.0)
+        return sound_active()
+
+    pico.api_sound_active = timed_sound_active
+
+    async def control():
+        while True:
+            if conn.poll():
+                conn.recv()
+                conn.send(ticks[:])
+                ticks.clear()
+            await asyncio.sleep(0.05)
+
+    async def run():
+        asyncio.create_task(control())
+        await pico.main()
+
+    asyncio.run(run())
+
+
+# --- Load generator ---
+
+
+async def read_response(reader):
+    status = await reader.readline()
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.partition(b":")
+        if name.strip().lower() == b"content-length":
+            length = int(value)
+    await reader.readexactly(length)
+    return status.split(b" ", 2)[1]
+
+
+async def client(port, names, weights, deadline, latencies, errors):
+    """One keep-alive connection issuing requests back to back until deadline."""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    encoded = {name: encode_request(*REQUESTS[name]) for name in names}
+    try:
+        while time.monotonic() < deadline:
+            name = random.choices(names, weights)[0]
+            started = time.perf_counter()
+            writer.write(encoded[name])
+            await writer.drain()
+            code = await read_response(reader)
+            latencies[name].append((time.perf_counter() - started) * 1000.0)
+            if not code.startswith(b"2"):
+                errors[name] = errors.get(name, 0) + 1
+    except (OSError, asyncio.IncompleteReadError) as e:
+        errors["connection"] = errors.get("connection", 0) + 1
+        print(f"Client error: {e}")
+    finally:
+        writer.close()
+
+
+async def run_level(port, concurrency, duration, mix):
+    names = list(mix)
+    weights = [mix[n] for n in names]
+    latencies = {name: [] for name in names}
+    errors = {}
+    deadline = time.monotonic() + duration
+    started = time.monotonic()
+    await asyncio.gather(*(
+        client(port, names, weights, deadline, latencies, errors) for _ in range(concurrency)
+    ))
+    elapsed = time.monotonic() - started
+    everything = [ms for values in latencies.values() for ms in values]
+    return {
+        "concurrency": concurrency,
+        "seconds": round(elapsed, 3),
+        "requests": len(everything),
+        "throughput_rps": round(len(everything) / elapsed, 1),
+        "latency_ms": summarize(everything),
+        "routes": {name: summarize(values) for name, values in latencies.items()},
+        "errors": errors,
+    }
+
+
+def tick_jitter(ticks):
+    """Light-loop tick intervals -> how far each strayed from LIGHT_LOOP_MS."""
+    intervals = [b - a for a, b in zip(ticks, ticks[1:])]
+    lateness = [abs(i - LIGHT_LOOP_MS) for i in intervals]
+    stats = summarize(lateness)
+    stats["mean_interval_ms"] = sum(intervals) / len(intervals) if intervals else None
+    return stats
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        if name not in REQUESTS:
+            raise SystemExit(f"Unknown request type in --mix: {name}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def round_floats(value):
+    if isinstance(value, float):
+        return round(value, 3)
+    if isinstance(value, dict):
+        return {k: round_floats(v) for k, v in value.items()}
+    return value
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the device HTTP API")
+    parser.add_argument("--levels", default="1,2,4,8",
+                        help="concurrency levels (the device serves 8 connections at once)")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per level")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="weighted request mix")
+    parser.add_argument("--port", type=int, default=8090, help="virtual Pico HTTP port")
+    parser.add_argument("--out", default=None, help="JSON results file")
+    parser.add_argument("--dual-core", action="store_true",
+                        help="boot the firmware with DUAL_CORE (engine + sampler on core 1)")
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    levels = [int(level) for level in args.levels.split(",")]
+    out = args.out or time.strftime("benchmark-%Y%m%d-%H%M%S.json")
+
+    parent, child = multiprocessing.Pipe()
+    device = multiprocessing.Process(
+        target=serve, args=(args.port, args.port + 1, child, args.dual_core), daemon=True
+    )
+    device.start()
+    time.sleep(1.0)  # let the firmware bind its sockets
+
+    results = []
+    try:
+        for concurrency in levels:
+            parent.send("ticks")
+            parent.recv()  # discard ticks from before this level
+            level = asyncio.run(run_level(args.port, concurrency, args.duration, mix))
+            parent.send("ticks")
+            level["light_loop_jitter_ms"] = tick_jitter(parent.recv())
+            results.append(round_floats(level))
+
+            lat = level["latency_ms"]
+            jit = level["light_loop_jitter_ms"]
+            print(
+                f"c={concurrency:<3} {level['throughput_rps']:>8.1f} req/s  "
+                f"p50 {lat['p50'] or 0:6.2f} ms  p99 {lat['p99'] or 0:6.2f} ms  "
+                f"max {lat['max'] or 0:6.2f} ms  loop jitter p99 {jit['p99'] or 0:5.2f} ms  "
+                f"errors {sum(level['errors'].values())}"
+            )
+    finally:
+        device.terminate()
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "duration_s": args.duration,
+        "mix": mix,
+        "dual_core": args.dual_core,
+        "levels": results,
+    }
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved to {out}")
+
+
+if __name__ == "__main__":
+    main()
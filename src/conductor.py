@@ -2,14 +2,23 @@
 # To be run on a student's computer (not the Pico)
 # Requires the 'requests' library: pip install requests
 
+import argparse
+import json
+import socket
+import struct
+from concurrent.futures import ThreadPoolExecutor, wait
+
 import requests
 import time
 
+import discovery
+import score_compiler
+
 # --- Configuration ---
-# Students should populate this list with the IP address(es of their Picos
-PICO_IPS = [
-    "192.168.10.223",# Replace it with your Pico IP address in your local network
-]
+# Device addresses. Leave empty to discover the Picos on the network (see
+# discovery.py), or list them to skip discovery, e.g. ["192.168.10.223"].
+PICO_IPS: list[str] = []
+UDP_PORT = 5005  # Device-side binary command channel (see main.py)
 
 # --- Music Definition ---
 # Notes mapped to frequencies (in Hz)
@@ -43,47 +52,911 @@ SONG = [
 
 # --- Conductor Logic ---
 
+# One persistent HTTP/1.1 session per device, so a whole song streams over a
+# single open connection instead of paying a TCP handshake per note. Each
+# device also gets its own worker thread: notes fan out to every device at
+# once, a dead device only stalls its own queue, and each device still sees
+# its notes in order on a session no other thread touches.
+SESSIONS: dict[str, requests.Session] = {}
+WORKERS: dict[str, ThreadPoolExecutor] = {}
+
+
+def get_session(ip):
+    """Returns the keep-alive session for a device, creating it on first use."""
+    session = SESSIONS.get(ip)
+    if session is None:
+        session = requests.Session()
+        SESSIONS[ip] = session
+    return session
+
+
+def get_worker(ip):
+    """Returns the single-thread executor that sends to one device."""
+    worker = WORKERS.get(ip)
+    if worker is None:
+        worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"pico-{ip}")
+        WORKERS[ip] = worker
+    return worker
+
+
+def close_sessions():
+    """Stops the sender threads and closes every open device connection."""
+    for worker in WORKERS.values():
+        worker.shutdown(wait=True)
+    WORKERS.clear()
+    for session in SESSIONS.values():
+        session.close()
+    SESSIONS.clear()
+
+
+def new_timing():
+    """Per-device record of one send: when it left and how long the ack took."""
+    return {"sent_ms": host_ms(), "ack_ms": None, "error": None}
+
+
+# --- UDP Transport ---
+# Wire format shared with main.py: magic b"PL", type, flags, seq (u32), payload.
+UDP_TONE = struct.Struct("<2sBBIHHH")
+UDP_TONE_AT = struct.Struct("<2sBBIHHHI")
+UDP_STOP = struct.Struct("<2sBBI")
+UDP_ACK = struct.Struct("<2sBBIB")
+UDP_FLAGS_SEQ = struct.Struct("<BI")  # patched into pre-built packets at offset 3
+UDP_AT = struct.Struct("<I")          # ... and the start tick after a UDP_TONE
+UDP_MAGIC = b"PL"
+UDP_TYPE_TONE = 1
+UDP_TYPE_STOP = 2
+UDP_TYPE_TONE_AT = 4
+UDP_TYPE_ACK = 0x80
+UDP_FLAG_ACK = 0x01
+
+
+def udp_address(device):
+    """PICO_IPS entry ("host" or discovery's "host:http_port") -> its UDP command address."""
+    return device.rsplit(":", 1)[0], UDP_PORT
+
+
+class UdpTransport:
+    """Sends note commands to the devices as single binary datagrams."""
+
+    def __init__(self, want_ack=False, ack_timeout=0.05, retries=1):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.timings = {}
+        self.want_ack = want_ack
+        self.ack_timeout = ack_timeout
+        self.retries = retries
+        # Seed from the clock so a restarted conductor stays ahead of old seqs
+        self.seq = int(time.time() * 1000) & 0xFFFFFFFF
+
+    def next_seq(self):
+        self.seq = (self.seq + 1) & 0xFFFFFFFF
+        return self.seq
+
+    def send(self, packets, seq):
+        """Sends each device its packet ({ip: bytes}); returns the IPs that never acked.
+
+        Per-device send/ack timings of this call are left in self.timings.
+        """
+        pending = set(packets)
+        self.timings = {}
+        for _ in range(self.retries + 1 if self.want_ack else 1):
+            for ip in pending:
+                self.timings.setdefault(ip, new_timing())
+                try:
+                    self.sock.sendto(packets[ip], udp_address(ip))
+                except OSError as e:
+                    print(f"Error contacting {ip}: {e}")
+                    self.timings[ip]["error"] = type(e).__name__
+            if not self.want_ack:
+                return set()
+            self.collect_acks(pending, seq)
+            if not pending:
+                break
+        for ip in pending:
+            self.timings[ip]["error"] = self.timings[ip]["error"] or "no ack"
+        return pending
+
+    def collect_acks(self, pending, seq):
+        """Removes devices from `pending` as their acks for `seq` arrive."""
+        deadline = time.monotonic() + self.ack_timeout
+        devices = {udp_address(ip)[0]: ip for ip in pending}  # acks come from the bare host
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            self.sock.settimeout(remaining)
+            try:
+                data, (host, _) = self.sock.recvfrom(64)
+            except socket.timeout:
+                return
+            if len(data) != UDP_ACK.size:
+                continue
+            magic, kind, _, ack_seq, status = UDP_ACK.unpack(data)
+            ip = devices.get(host)
+            if magic == UDP_MAGIC and kind & UDP_TYPE_ACK and ack_seq == seq and ip in pending:
+                pending.discard(ip)
+                self.timings[ip]["ack_ms"] = host_ms() - self.timings[ip]["sent_ms"]
+                if status:
+                    print(f"{ip} rejected command (status {status})")
+
+    def tone(self, ips, freq, ms, duty_u16=0):
+        seq = self.next_seq()
+        flags = UDP_FLAG_ACK if self.want_ack else 0
+        packet = UDP_TONE.pack(UDP_MAGIC, UDP_TYPE_TONE, flags, seq, int(freq), int(ms), duty_u16)
+        return self.send(dict.fromkeys(ips, packet), seq)
+
+    def tone_at(self, starts, freq, ms, duty_u16=0):
+        """Schedules a tone at each device's own start tick ({ip: ticks_ms})."""
+        seq = self.next_seq()
+        flags = UDP_FLAG_ACK if self.want_ack else 0
+        packets = {
+            ip: UDP_TONE_AT.pack(
+                UDP_MAGIC, UDP_TYPE_TONE_AT, flags, seq, int(freq), int(ms), duty_u16, at
+            )
+            for ip, at in starts.items()
+        }
+        return self.send(packets, seq)
+
+    def send_built(self, packets, starts=None):
+        """Sends pre-built datagrams ({ip: bytes}) from score_compiler under one new seq.
+
+        Only the flags and seq (and, for UDP_TONE_AT packets, the start tick
+        from `starts`) are patched in; returns the IPs that never acked.
+        """
+        seq = self.next_seq()
+        flags = UDP_FLAG_ACK if self.want_ack else 0
+        stamped = {}
+        for ip, packet in packets.items():
+            buf = bytearray(packet)
+            UDP_FLAGS_SEQ.pack_into(buf, 3, flags, seq)
+            if starts is not None:
+                UDP_AT.pack_into(buf, UDP_TONE.size, starts[ip])
+            stamped[ip] = buf
+        return self.send(stamped, seq)
+
+    def stop(self, ips):
+        seq = self.next_seq()
+        flags = UDP_FLAG_ACK if self.want_ack else 0
+        packet = UDP_STOP.pack(UDP_MAGIC, UDP_TYPE_STOP, flags, seq)
+        return self.send(dict.fromkeys(ips, packet), seq)
+
+    def close(self):
+        self.sock.close()
+
+
+# --- Clock Synchronization ---
+TICKS_PERIOD = 1 << 30  # MicroPython time.ticks_ms() wraps at 2**30
+SYNC_EXCHANGES = 8      # /time round trips per sync round; the fastest one wins
+SYNC_HISTORY = 8        # rounds kept for the drift fit
+MAX_DRIFT = 50e-6       # crystal tolerance; larger fits are noise
+DRIFT_MIN_SPAN_MS = 30000  # rounds closer together than this leave drift at 0
+
+
+def host_ms():
+    """Conductor clock in milliseconds."""
+    return time.monotonic() * 1000.0
+
+
+class DeviceClock:
+    """NTP-style offset/drift estimate mapping host_ms() onto a device's ticks_ms()."""
 
-def play_note_on_all_picos(freq, ms):
-    """Sends a /tone POST request to every Pico in the list."""
+    def __init__(self):
+        self.rounds = []  # (host midpoint, offset) of the best exchange per round
+        self.offset = None
+        self.drift = 0.0  # extra device ms per host ms
+        self.ref = 0.0
+
+    def add_round(self, exchanges):
+        """Folds in one round of (host send, device ticks, host receive) exchanges."""
+        sent, ticks, received = min(exchanges, key=lambda e: e[2] - e[0])
+        mid = (sent + received) / 2
+        offset = ticks - mid
+        if self.offset is not None:
+            # Unwrap ticks_ms so the offset stays continuous across the 2**30 wrap
+            expected = self.offset + self.drift * (mid - self.ref)
+            offset += round((expected - offset) / TICKS_PERIOD) * TICKS_PERIOD
+        self.rounds = (self.rounds + [(mid, offset)])[-SYNC_HISTORY:]
+
+        # Least-squares line through the rounds: intercept = offset, slope = drift
+        n = len(self.rounds)
+        self.ref = sum(m for m, _ in self.rounds) / n
+        mean_offset = sum(o for _, o in self.rounds) / n
+        spread = sum((m - self.ref) ** 2 for m, _ in self.rounds)
+        # Over a few seconds round-trip jitter outweighs any real drift, so the
+        # slope is only fitted once the rounds are far enough apart
+        if self.rounds[-1][0] - self.rounds[0][0] < DRIFT_MIN_SPAN_MS:
+            self.drift = 0.0
+        elif spread > 0:
+            drift = sum((m - self.ref) * (o - mean_offset) for m, o in self.rounds) / spread
+            self.drift = max(-MAX_DRIFT, min(MAX_DRIFT, drift))
+        self.offset = mean_offset
+        return received - sent
+
+    def device_time(self, host_time):
+        """Host time (ms) -> unwrapped device time at the same instant."""
+        return host_time + self.offset + self.drift * (host_time - self.ref)
+
+    def to_device(self, host_time):
+        """Host time (ms) -> device ticks_ms at the same instant."""
+        return int(round(self.device_time(host_time))) % TICKS_PERIOD
+
+    def to_host(self, ticks, near):
+        """Device ticks_ms -> host time (ms), taking the wrap period closest to `near`."""
+        expected = self.device_time(near)
+        device = ticks + round((expected - ticks) / TICKS_PERIOD) * TICKS_PERIOD
+        return near + (device - expected) / (1 + self.drift)
+
+
+CLOCKS: dict[str, DeviceClock] = {}
+
+
+def sync_clock(ip, exchanges=SYNC_EXCHANGES):
+    """Runs one /time sync round against a device; returns the best RTT in ms."""
+    samples = []
+    for _ in range(exchanges):
+        sent = host_ms()
+        res = get_session(ip).get(f"http://{ip}/time", timeout=0.5)
+        received = host_ms()
+        res.raise_for_status()
+        samples.append((sent, res.json()["ticks_ms"], received))
+    return CLOCKS.setdefault(ip, DeviceClock()).add_round(samples)
+
+
+def sync_all_clocks():
+    """One sync round for every device; unreachable devices keep their old estimate."""
+    for ip in PICO_IPS:
+        try:
+            rtt = sync_clock(ip)
+            clock = CLOCKS[ip]
+            print(f"{ip}: offset {clock.offset:.1f} ms, drift {clock.drift * 1e6:.0f} ppm, "
+                  f"RTT {rtt:.1f} ms")
+        except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+            print(f"Clock sync failed for {ip}: {e}")
+
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+NOTE_WAIT_S = 0.02  # how long a note waits for the devices' sends before moving on
+
+
+def post_note(ip, payload, timing=None):
+    """Posts one note on the device's keep-alive session; returns its timing."""
+    return post_note_body(ip, json.dumps(payload).encode("utf-8"), timing)
+
+
+def post_note_body(ip, body, timing=None):
+    """Posts an already encoded /play_note body; returns its timing.
+
+    A `timing` record passed in is filled in place, so a caller that stopped
+    waiting still sees the result once it arrives.
+    """
+    timing = new_timing() if timing is None else timing
+    timing["sent_ms"] = host_ms()
+    url = f"http://{ip}/play_note"
+    try:
+        # We use a short timeout because we don't need to wait for a response
+        # This makes the orchestra play more in sync.
+        get_session(ip).post(url, data=body, headers=JSON_HEADERS, timeout=0.1)
+        timing["ack_ms"] = host_ms() - timing["sent_ms"]
+    except requests.exceptions.ConnectTimeout as e:
+        # The request never reached the device, so nothing will play
+        print(f"Error contacting {ip}: {e}")
+        timing["error"] = type(e).__name__
+    except requests.exceptions.ReadTimeout:
+        # The device has the request; we just didn't wait for the reply
+        timing["error"] = "timeout"
+    except requests.exceptions.RequestException as e:
+        print(f"Error contacting {ip}: {e}")
+        timing["error"] = type(e).__name__
+    return timing
+
+
+def play_note_on_all_picos(freq, ms, udp=None, at=None, seq=None):
+    """Sends the note to every Pico at once: over HTTP /play_note, or as a UDP datagram.
+
+    With `at` (a host_ms() time) the note is scheduled to start at that instant
+    on every synchronized device instead of on arrival. `seq` tags the HTTP
+    note for the devices' play logs (UDP datagrams carry their own). Returns
+    per-device timings: {ip: {"sent_ms", "ack_ms", "error", "seq"}}.
+    """
     print(f"Playing note: {freq}Hz for {ms}ms on all devices.")
 
-    payload = {"frequency": float(freq), "duration": ms / 1000.0}
+    starts = {}
+    if at is not None:
+        starts = {ip: CLOCKS[ip].to_device(at) for ip in PICO_IPS if ip in CLOCKS}
+
+    if udp is not None:
+        unacked = udp.tone_at(starts, freq, ms) if starts else udp.tone(PICO_IPS, freq, ms)
+        for ip in unacked:
+            print(f"No ack from {ip}")
+        for timing in udp.timings.values():
+            timing["seq"] = udp.seq
+        return udp.timings
 
+    # Queue every send first so all device threads start together
+    timings = {}
+    futures = []
     for ip in PICO_IPS:
-        url = f"http://{ip}/play_note"
+        payload = {"frequency": float(freq), "duration": ms / 1000.0}
+        if ip in starts:
+            payload["at"] = starts[ip]
+        if seq is not None:
+            payload["seq"] = seq
+        timing = timings[ip] = new_timing()
+        timing["seq"] = seq
+        futures.append(get_worker(ip).submit(post_note, ip, payload, timing))
+    # Don't let a dead device hold up the next note: wait briefly, then move
+    # on; a late send still fills in its timing when its worker gets to it
+    wait(futures, timeout=NOTE_WAIT_S)
+    return timings
+
+
+# --- Voice Allocation ---
+# Each device is monophonic, so a polyphonic score needs every note assigned
+# to a device. The allocator does that note group by note group while the
+# song plays, which lets it route around a device that stops answering and
+# take it back once it answers /health again.
+VOICE_STRATEGIES = ("unison", "round-robin", "lru", "sections")
+REPROBE_MS = 5000  # how often a dropped device is checked for a comeback
+
+
+class VoiceAllocator:
+    """Assigns the notes of a score to monophonic devices.
+
+    unison: every device plays every note (the score's melody line).
+    round-robin: each note goes to the next idle device in turn.
+    lru: each note goes to the device that has been idle the longest.
+    sections: the devices are dealt into one section per voice, ranked by
+    pitch among the sounding notes (highest = section 0); every device in a
+    section plays its voice.
+    A note that finds no idle device takes over the one whose note started
+    first; notes beyond the number of devices are left out.
+    """
+
+    def __init__(self, ips, strategy="unison", voices=1):
+        if strategy not in VOICE_STRATEGIES:
+            raise ValueError(f"Unknown voice strategy: {strategy}")
+        self.ips = list(ips)
+        self.live = list(ips)
+        self.strategy = strategy
+        self.voices = max(1, voices)
+        self.next = 0
+        self.busy_until = dict.fromkeys(self.ips, 0)  # score ms each device's note ends
+        self.started = dict.fromkeys(self.ips, 0)     # score ms its current note started
+        self.sounding = []  # (end ms, freq) of assigned notes, for section ranks
+        self.sections = []
+        self.rebalance()
+
+    def rebalance(self):
+        """Deals the live devices into sections: voice i gets devices i, i + n, ..."""
+        count = max(1, min(self.voices, len(self.live)))
+        self.sections = [self.live[i::count] for i in range(count)]
+        self.next = self.next % len(self.live) if self.live else 0
+
+    def drop(self, ip):
+        if ip in self.live:
+            self.live.remove(ip)
+            self.rebalance()
+            print(f"{ip} dropped out, {len(self.live)} devices left")
+
+    def restore(self, ip):
+        if ip in self.ips and ip not in self.live:
+            self.live = [x for x in self.ips if x in self.live or x == ip]
+            self.rebalance()
+            print(f"{ip} is back, {len(self.live)} devices playing")
+
+    def assign(self, offset, notes, exclude=()):
+        """Notes [(index, freq, ms)] starting at score ms `offset` -> [(ip, index)]."""
+        live = [ip for ip in self.live if ip not in exclude]
+        if not live:
+            return []
+        if self.strategy == "unison":
+            return [(ip, k) for k, _, _ in notes[:1] for ip in live]
+        if self.strategy == "sections":
+            return self.assign_sections(offset, notes, live)
+
+        assigned = []
+        taken = set()
+        for k, _, ms in notes:
+            free = [ip for ip in live if ip not in taken]
+            if not free:
+                break
+            idle = [ip for ip in free if self.busy_until[ip] <= offset]
+            if not idle:
+                ip = min(free, key=self.started.get)
+            elif self.strategy == "lru":
+                ip = min(idle, key=self.busy_until.get)
+            else:
+                for step in range(len(self.live)):
+                    ip = self.live[(self.next + step) % len(self.live)]
+                    if ip in idle:
+                        self.next = (self.next + step + 1) % len(self.live)
+                        break
+            self.busy_until[ip] = offset + ms
+            self.started[ip] = offset
+            taken.add(ip)
+            assigned.append((ip, k))
+        return assigned
+
+    def assign_sections(self, offset, notes, live):
+        self.sounding = [note for note in self.sounding if note[0] > offset]
+        by_section = {}
+        for k, freq, _ in notes:
+            rank = sum(1 for _, f in self.sounding if f > freq)
+            rank += sum(1 for _, f, _ in notes if f > freq)
+            section = min(rank, len(self.sections) - 1)
+            by_section.setdefault(section, []).append(k)
+        for _, freq, ms in notes:
+            self.sounding.append((offset + ms, freq))
+
+        assigned = []
+        for section, indices in by_section.items():
+            members = [ip for ip in self.sections[section] if ip in live] or live
+            # Several notes in one section share its devices
+            for j, ip in enumerate(members):
+                assigned.append((ip, indices[j % len(indices)]))
+        return assigned
+
+
+def score_track(compiled, allocator):
+    """The compiled track an allocator plays: the melody line for unison, else every note."""
+    return compiled["tracks"]["melody" if allocator.strategy == "unison" else "all"]
+
+
+def note_groups(track):
+    """[(offset_ms, [(index, freq, ms), ...]), ...]: notes of a track by start time."""
+    groups = []
+    for k, offset in enumerate(track["offsets"]):
+        note = (k, track["freqs"][k], track["ms"][k])
+        if groups and groups[-1][0] == offset:
+            groups[-1][1].append(note)
+        else:
+            groups.append((offset, [note]))
+    return groups
+
+
+def probe_device(ip):
+    """True if a dropped device answers /health again."""
+    try:
+        return get_session(ip).get(f"http://{ip}/health", timeout=0.5).ok
+    except requests.exceptions.RequestException:
+        return False
+
+
+def check_dropped(allocator, probes):
+    """Starts /health probes for dropped devices and restores those that answer.
+
+    `probes` maps ip -> (next probe host_ms, pending future or None).
+    """
+    now = host_ms()
+    for ip in allocator.ips:
+        if ip in allocator.live:
+            probes.pop(ip, None)
+            continue
+        retry_at, future = probes.get(ip, (now + REPROBE_MS, None))
+        if future is not None and future.done():
+            if future.result():
+                allocator.restore(ip)
+                probes.pop(ip, None)
+                continue
+            retry_at, future = now + REPROBE_MS, None
+        if future is None and now >= retry_at:
+            future = get_worker(ip).submit(probe_device, ip)
+        probes[ip] = (retry_at, future)
+
+
+# --- Compiled Playback ---
+# Songs are compiled once by score_compiler into per-note bytes; playback
+# only appends a seq (and a start tick) to bodies that are already built.
+
+
+def send_compiled(track, assigned, seq, udp, starts):
+    """Sends each (ip, note index) in `assigned`; returns (timings, failed IPs)."""
+    if udp is not None:
+        kind = "udp_at" if starts else "udp"
+        packets = {ip: track[kind][k] for ip, k in assigned}
+        failed = udp.send_built(packets, starts or None)
+        for timing in udp.timings.values():
+            timing["seq"] = udp.seq
+        return udp.timings, failed
+
+    timings = {}
+    futures = []
+    for ip, k in assigned:
+        if starts:
+            body = track["http"][k] + b'%d, "at": %d}' % (seq, starts[ip])
+        else:
+            body = track["http"][k] + b"%d}" % seq
+        timing = timings[ip] = new_timing()
+        timing["seq"] = seq
+        futures.append(get_worker(ip).submit(post_note_body, ip, body, timing))
+    # As in play_note_on_all_picos, a slow device must not hold up the next
+    # group; its timing fills in once the send finishes
+    wait(futures, timeout=NOTE_WAIT_S)
+    return timings, failed_sends(timings)
+
+
+def failed_sends(timings):
+    """IPs whose send has failed so far; a read timeout is normal (we don't wait for replies)."""
+    return {ip for ip, timing in timings.items() if timing["error"] not in (None, "timeout")}
+
+
+def play_compiled(compiled, allocator, udp=None, ahead_ms=0, seq=0):
+    """Plays a compiled score note group by note group; returns per-group timings.
+
+    With `ahead_ms` every note is sent that early with each device's start
+    tick (clocks must be synchronized); otherwise notes are sent on time.
+    Devices whose sends fail are dropped from the allocator, their notes go
+    to the others, and they rejoin once they answer /health again.
+    """
+    track = score_track(compiled, allocator)
+    start = host_ms() + ahead_ms
+    sent = []
+    probes = {}
+    for offset, notes in note_groups(track):
+        at = start + offset
+        time.sleep(max(0.0, (at - ahead_ms - host_ms()) / 1000))
+        if sent:
+            # Sends that failed after send_compiled stopped waiting for them
+            for ip in failed_sends(sent[-1]):
+                allocator.drop(ip)
+        check_dropped(allocator, probes)
+        seq += 1
+        assigned = allocator.assign(offset, notes)
+        print(f"Playing {len(notes)} note(s) at {offset / 1000:.2f} s on {len(assigned)} devices.")
+        timings = {}
+        for _ in range(2):  # one retry round for notes whose device failed
+            timed = ahead_ms and all(ip in CLOCKS for ip, _ in assigned)
+            starts = {ip: CLOCKS[ip].to_device(at) for ip, _ in assigned} if timed else {}
+            results, failed = send_compiled(track, assigned, seq, udp, starts)
+            timings.update(results)
+            if not failed:
+                break
+            for ip in failed:
+                allocator.drop(ip)
+            lost = {k for ip, k in assigned if ip in failed}
+            retry = [note for note in notes if note[0] in lost]
+            assigned = allocator.assign(offset, retry, exclude=timings)
+        sent.append(timings)
+    time.sleep(max(0.0, (start + compiled["duration_ms"] - host_ms()) / 1000))
+    return sent
+
+
+# --- Score Mode ---
+# Instead of one request per note, every device's part is uploaded up front
+# and started with a single scheduled /score/start; each device then plays it
+# against its own clock with no network traffic during the song. Parts are
+# allocated before the upload, so only devices that took theirs get notes.
+SCORE_LEAD_MS = 500     # how far ahead of "now" the synchronized start is set
+SCORE_MAX_BYTES = 8192  # the devices' /score body limit (MAX_SCORE_BYTES in main.py)
+SCORE_MAX_NOTES = 256   # and entries in one score (SCORE_MAX_NOTES in main.py)
+
+
+def post_json(ip, path, payload):
+    """Posts JSON on the device's session; returns (timing, parsed reply or None)."""
+    timing = new_timing()
+    try:
+        if not isinstance(payload, bytes):
+            payload = json.dumps(payload).encode("utf-8")
+        response = get_session(ip).post(
+            f"http://{ip}{path}", data=payload, headers=JSON_HEADERS, timeout=2
+        )
+        timing["ack_ms"] = host_ms() - timing["sent_ms"]
+        if response.status_code >= 300:
+            timing["error"] = f"HTTP {response.status_code}"
+            return timing, None
+        return timing, response.json()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"Error contacting {ip}: {e}")
+        timing["error"] = type(e).__name__
+        return timing, None
+
+
+def allocate_parts(track, allocator):
+    """Runs the allocator over the whole track -> ({ip: [note indices]}, per-group assignments)."""
+    parts = {ip: [] for ip in allocator.live}
+    groups = []
+    for offset, notes in note_groups(track):
+        assigned = allocator.assign(offset, notes)
+        for ip, k in assigned:
+            parts[ip].append(k)
+        groups.append((offset, assigned))
+    return parts, groups
+
+
+def part_bodies(track, parts, seq):
+    """Builds each device's /score body -> {ip: (body, score positions)}.
+
+    Raises ValueError if a part holds more entries or bytes than a device
+    accepts (durations always fit: score_body() splits long rests).
+    """
+    bodies = {}
+    for ip, indices in parts.items():
+        body, positions = score_compiler.score_body(track, indices)
+        body += b"%d}" % seq
+        entries = max(positions.values(), default=-1) + 1  # the last entry is a note
+        if entries > SCORE_MAX_NOTES:
+            raise ValueError(f"{ip}: part has {entries} entries, "
+                             f"over the device's {SCORE_MAX_NOTES} entry limit")
+        if len(body) > SCORE_MAX_BYTES:
+            raise ValueError(f"{ip}: part is {len(body)} bytes, "
+                             f"over the device's {SCORE_MAX_BYTES} byte limit")
+        bodies[ip] = (body, positions)
+    return bodies
+
+
+def upload_parts(bodies):
+    """Uploads each device's /score body; returns ({ip: score positions}, failed IPs)."""
+    uploads = {
+        ip: get_worker(ip).submit(post_json, ip, "/score", body)
+        for ip, (body, _) in bodies.items()
+    }
+    positions = {}
+    failed = set()
+    for ip, future in uploads.items():
+        timing, reply = future.result()
+        if reply is None:
+            print(f"{ip}: score upload failed ({timing['error']})")
+            failed.add(ip)
+        else:
+            print(f"{ip}: {reply['notes']} notes, {reply['duration_ms']} ms "
+                  f"(upload {timing['ack_ms']:.1f} ms)")
+            positions[ip] = bodies[ip][1]
+    return positions, failed
+
+
+def play_score_on_all_picos(compiled, allocator, seq):
+    """Uploads each device's part, then starts them all at one synchronized instant.
+
+    Returns per-group timings shaped like play_compiled() results (with the
+    scheduled start as "sent_ms"), so the skew report works unchanged. A song
+    whose parts don't fit on the devices is streamed with play_compiled().
+    """
+    track = score_track(compiled, allocator)
+    for ip in allocator.ips:
+        if ip not in CLOCKS:
+            print(f"{ip}: clock not synchronized, skipped")
+            allocator.drop(ip)
+    positions = {}
+    groups = []
+    for _ in range(2):  # reallocate once around devices that refused their part
+        parts, groups = allocate_parts(track, allocator)
         try:
-            # We use a short timeout because we don't need to wait for a response
-            # This makes the orchestra play more in sync.
-            requests.post(url, json=payload, timeout=0.1)
-        except requests.exceptions.Timeout:
-            # This is expected, we can ignore it
-            pass
-        except requests.exceptions.RequestException as e:
-            print(f"Error contacting {ip}: {e}")
+            bodies = part_bodies(track, parts, seq)
+        except ValueError as e:
+            print(f"{e}; streaming the notes instead")
+            return play_compiled(compiled, allocator, ahead_ms=SCORE_LEAD_MS, seq=seq - 1)
+        positions, failed = upload_parts(bodies)
+        for ip in failed:
+            allocator.drop(ip)
+        if not failed:
+            break
+
+    at = host_ms() + SCORE_LEAD_MS
+    starts = {
+        ip: get_worker(ip).submit(
+            post_json, ip, "/score/start", {"at": CLOCKS[ip].to_device(at)}
+        )
+        for ip in positions
+    }
+    for ip, future in starts.items():
+        timing, reply = future.result()
+        if reply is None:
+            print(f"{ip}: score start failed ({timing['error']})")
+            del positions[ip]
+
+    sent = []
+    for offset, assigned in groups:
+        timings = {}
+        for ip, k in assigned:
+            if ip in positions:
+                timings[ip] = {"sent_ms": at + offset, "ack_ms": None, "error": None,
+                               "seq": seq + positions[ip][k]}
+        sent.append(timings)
+    time.sleep(max(0.0, (at + compiled["duration_ms"] - host_ms()) / 1000))
+    return sent
+
+
+# --- Fleet Calibration ---
+
+
+def calibrate_all_picos(seconds):
+    """Runs /calibrate on every device at once and prints the applied ranges."""
+    ms = int(seconds * 1000)
+    starts = {
+        ip: get_worker(ip).submit(post_json, ip, "/calibrate", {"action": "start", "ms": ms})
+        for ip in PICO_IPS
+    }
+    running = [ip for ip, future in starts.items() if future.result()[1] is not None]
+    print(f"Calibrating {len(running)} devices for {seconds:g} s "
+          "(sweep the light from dark to bright)...")
+    time.sleep(seconds + 0.2)
+
+    print(f"\n{'IP Address':<18} {'samples':>7} {'P10':>7} {'P90':>7} {'applied':>8}")
+    for ip in running:
+        try:
+            status = get_session(ip).get(f"http://{ip}/calibrate", timeout=1).json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"{ip:<18} could not read calibration: {e}")
+            continue
+        applied = (status["min_light"], status["max_light"]) == (status["p10"], status["p90"])
+        print(f"{ip:<18} {status['samples']:>7} {status['p10'] or '-':>7} "
+              f"{status['p90'] or '-':>7} {'yes' if applied else 'no':>8}")
+
+
+# --- Skew Measurement ---
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of an unsorted list."""
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[rank]
+
+
+def fetch_play_times(sent):
+    """Joins the devices' /playlog with what we sent.
+
+    `sent` is a list of play_note_on_all_picos() results, one per note.
+    Returns {note index: {ip: host time the note reached the PWM}}.
+    """
+    by_seq = {}
+    for index, timings in enumerate(sent):
+        for ip, timing in timings.items():
+            by_seq[(ip, timing["seq"])] = (index, timing["sent_ms"])
+
+    played = {}
+    for ip in PICO_IPS:
+        clock = CLOCKS.get(ip)
+        if clock is None:
+            print(f"{ip}: clock not synchronized, skipped")
+            continue
+        try:
+            log = get_session(ip).get(f"http://{ip}/playlog", timeout=1).json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"{ip}: could not fetch /playlog: {e}")
+            continue
+        for seq, ticks in zip(log["seq"], log["ticks_ms"]):
+            match = by_seq.get((ip, seq))
+            if match is not None:
+                index, sent_ms = match
+                played.setdefault(index, {})[ip] = clock.to_host(ticks, sent_ms)
+    return played
+
+
+def print_skew_report(sent, played):
+    """Per-note skew (device start minus the earliest device) and summaries."""
+    print("\n--- Skew per note (ms after the first device to start) ---")
+    print(f"{'Note':<6}" + "".join(f"{ip:>18}" for ip in PICO_IPS))
+    skews = {ip: [] for ip in PICO_IPS}
+    latencies = {ip: [] for ip in PICO_IPS}
+    spreads = []
+    for index in sorted(played):
+        starts = played[index]
+        first = min(starts.values())
+        cells = []
+        for ip in PICO_IPS:
+            if ip in starts:
+                skews[ip].append(starts[ip] - first)
+                latencies[ip].append(starts[ip] - sent[index][ip]["sent_ms"])
+                cells.append(f"{starts[ip] - first:>18.1f}")
+            else:
+                cells.append(f"{'-':>18}")
+        spreads.append(max(starts.values()) - first)
+        print(f"{index:<6}" + "".join(cells))
+
+    print("\n--- Per device (ms) ---")
+    print(f"{'IP Address':<18} {'notes':>5} {'skew p50':>9} {'p95':>7} {'max':>7} "
+          f"{'send->play p50':>15}")
+    for ip in PICO_IPS:
+        if skews[ip]:
+            print(f"{ip:<18} {len(skews[ip]):>5} {percentile(skews[ip], 50):>9.1f} "
+                  f"{percentile(skews[ip], 95):>7.1f} {max(skews[ip]):>7.1f} "
+                  f"{percentile(latencies[ip], 50):>15.1f}")
+        else:
+            print(f"{ip:<18} {0:>5} {'-':>9} {'-':>7} {'-':>7} {'-':>15}")
+    if spreads:
+        print(f"\nNote spread across devices: p50 {percentile(spreads, 50):.1f} ms, "
+              f"p95 {percentile(spreads, 95):.1f} ms, max {max(spreads):.1f} ms")
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pico Light Orchestra conductor")
+    parser.add_argument(
+        "--transport", choices=("http", "udp"), default="http",
+        help="send notes as HTTP requests or binary UDP datagrams",
+    )
+    parser.add_argument(
+        "--ack", action="store_true", help="with --transport udp, wait for acks and retry once"
+    )
+    parser.add_argument(
+        "--ahead-ms", type=int, default=0,
+        help="sync clocks and send each note this far ahead with a device start time",
+    )
+    parser.add_argument(
+        "--measure-skew", action="store_true",
+        help="after the song, read each device's play log and report per-note skew",
+    )
+    parser.add_argument(
+        "--score-mode", action="store_true",
+        help="upload the whole song over HTTP and start it on every device at once",
+    )
+    parser.add_argument(
+        "--score", default=None,
+        help="play a Standard MIDI File or text score instead of the built-in SONG",
+    )
+    parser.add_argument(
+        "--voices", choices=VOICE_STRATEGIES, default="unison",
+        help="how notes are spread over the devices (unison = all play the melody)",
+    )
+    parser.add_argument("--tempo", type=float, default=None, help="score tempo in bpm")
+    parser.add_argument(
+        "--transpose", type=int, default=0, help="transpose the song by this many semitones"
+    )
+    parser.add_argument(
+        "--calibrate", type=float, metavar="SECONDS",
+        help="calibrate every device's light range for this long instead of playing",
+    )
+    parser.add_argument(
+        "--rediscover", action="store_true",
+        help="broadcast for devices even if the discovery cache is fresh",
+    )
+    args = parser.parse_args()
+    if not PICO_IPS:
+        PICO_IPS[:] = discovery.find_devices(refresh=args.rediscover)
+        if not PICO_IPS:
+            raise SystemExit("No devices found; list them in PICO_IPS instead.")
+    if args.calibrate:
+        try:
+            calibrate_all_picos(args.calibrate)
+        finally:
+            close_sessions()
+        raise SystemExit
+    sync = args.ahead_ms or args.measure_skew or args.score_mode
+    # Note numbers for the devices' play logs, seeded so reruns don't collide
+    note_seq = int(time.time() * 1000) & 0xFFFFFFFF
+    sent = []
+    compiled = score_compiler.compile_score(args.score or SONG, args.tempo, args.transpose)
+    allocator = VoiceAllocator(PICO_IPS, args.voices, compiled["polyphony"])
+    udp = UdpTransport(want_ack=args.ack) if args.transport == "udp" else None
+
     print("--- Pico Light Orchestra Conductor ---")
     print(f"Found {len(PICO_IPS)} devices in the orchestra.")
     print("Press Ctrl+C to stop.")
 
     try:
-        # Give a moment for everyone to get ready
+        # Give a moment for everyone to get ready (and measure clocks meanwhile,
+        # so the offset averages several rounds)
         print("\nStarting in 3...")
+        if sync:
+            sync_all_clocks()
         time.sleep(1)
         print("2...")
+        if sync:
+            sync_all_clocks()
         time.sleep(1)
         print("1...")
+        if sync:
+            sync_all_clocks()
         time.sleep(1)
         print("Go!\n")
 
         # Play the song
-        for note, duration in SONG:
-            play_note_on_all_picos(note, duration)
-            # Wait for the note's duration plus a small gap before playing the next one
-            time.sleep(duration / 1000 * 1.02)
+        if args.score_mode:
+            sent = play_score_on_all_picos(compiled, allocator, note_seq + 1)
+        else:
+            # Notes go out on the song's own timeline; with --ahead-ms each is
+            # sent that early with a start time the devices hold it for.
+            sent = play_compiled(compiled, allocator, udp, args.ahead_ms, note_seq)
 
         print("\nSong finished!")
 
+        if args.measure_skew:
+            time.sleep(1)  # let scheduled notes drain before reading the logs
+            sync_all_clocks()
+            print_skew_report(sent, fetch_play_times(sent))
+
     except KeyboardInterrupt:
         print("\nConductor stopped by user.")
+    finally:
+        close_sessions()
+        if udp is not None:
+            udp.close()
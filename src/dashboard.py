@@ -1,39 +1,92 @@
 # dashboard.py
 # To be run on a student's computer (not the Pico)
 
+import argparse
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
 import requests
 import time
 
+import discovery
+
 # --- Configuration ---
-# Students should populate this list with the IP address(es) of their Pico
-PICO_IPS = [
-    "192.168.10.223",
-]
+# Device addresses. Leave empty to discover the Picos on the network (see
+# discovery.py), or list them to skip discovery, e.g. ["192.168.10.223"].
+PICO_IPS: list[str] = []
+MAX_PARALLEL = 16   # devices polled at the same time
+DEADLINE_S = 1.0    # a device that hasn't answered by then shows as timed out
 
 
-def get_device_status(ip):
-    """Fetches /health and /sensor data from a single device."""
+def get_device_status(ip, timeout=DEADLINE_S):
+    """Fetches health and sensor data from a single device.
+
+    Uses the combined /status endpoint; firmware without it answers 404 and is
+    polled through /health and /sensor instead.
+    """
     status = {"ip": ip, "device_id": "N/A", "status": "Error", "norm": 0.0}
     try:
+        res = requests.get(f"http://{ip}/status", timeout=timeout)
+        if res.status_code != 404:
+            data = res.json()
+            status.update(data)
+            status["status"] = data.get("status", "Unknown")
+            return status
+
         # Get health status
-        health_res = requests.get(f"http://{ip}/health", timeout=1)
+        health_res = requests.get(f"http://{ip}/health", timeout=timeout)
         health_res.raise_for_status()
         health_data = health_res.json()
         status.update(health_data)
         status["status"] = health_data.get("status", "Unknown")
 
         # Get sensor data
-        sensor_res = requests.get(f"http://{ip}/sensor", timeout=1)
+        sensor_res = requests.get(f"http://{ip}/sensor", timeout=timeout)
         sensor_res.raise_for_status()
         sensor_data = sensor_res.json()
         status["norm"] = sensor_data.get("norm", 0.0)
 
-    except requests.exceptions.RequestException as e:
+    except (requests.exceptions.RequestException, ValueError) as e:
         status["status"] = f"Offline ({type(e).__name__})"
 
     return status
 
 
+def poll_all(executor, ips, deadline_s=DEADLINE_S):
+    """Polls every device concurrently; the whole refresh ends at deadline_s."""
+    futures = [executor.submit(get_device_status, ip, deadline_s) for ip in ips]
+    wait(futures, timeout=deadline_s)
+    statuses = []
+    for ip, future in zip(ips, futures):
+        if future.done():
+            statuses.append(future.result())
+        else:
+            statuses.append({"ip": ip, "device_id": "N/A", "status": "Timeout", "norm": 0.0})
+    return statuses
+
+
+def follow_events(ip, statuses):
+    """Keeps statuses[ip] current from the device's /events stream.
+
+    Runs in its own thread; identity comes from one /health poll, after which
+    light readings arrive over a single long-lived connection.
+    """
+    while True:
+        status = get_device_status(ip)
+        statuses[ip] = status
+        try:
+            with requests.get(f"http://{ip}/events", stream=True, timeout=5) as res:
+                res.raise_for_status()
+                # One byte per read, so each sample is handled as soon as it arrives
+                for line in res.iter_lines(chunk_size=1):
+                    if line.startswith(b"data: "):
+                        status["norm"] = json.loads(line[6:]).get("norm", 0.0)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            status["status"] = f"Offline ({type(e).__name__})"
+        time.sleep(1)  # back off before reconnecting
+
+
 def render_dashboard(statuses):
     """Renders the collected statuses to the console."""
 
@@ -57,11 +110,37 @@ def render_dashboard(statuses):
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pico Orchestra dashboard")
+    parser.add_argument(
+        "--events", action="store_true",
+        help="follow each device's /events stream instead of polling",
+    )
+    parser.add_argument(
+        "--rediscover", action="store_true",
+        help="broadcast for devices even if the discovery cache is fresh",
+    )
+    args = parser.parse_args()
+    if not PICO_IPS:
+        PICO_IPS[:] = discovery.find_devices(refresh=args.rediscover)
+        if not PICO_IPS:
+            raise SystemExit("No devices found; list them in PICO_IPS instead.")
+
     try:
-        while True:
-            all_statuses = [get_device_status(ip) for ip in PICO_IPS]
-            render_dashboard(all_statuses)
-            time.sleep(1)  # Refresh every second
+        if args.events:
+            streamed: dict[str, dict] = {}
+            for ip in PICO_IPS:
+                threading.Thread(target=follow_events, args=(ip, streamed), daemon=True).start()
+            while True:
+                render_dashboard([streamed[ip] for ip in PICO_IPS if ip in streamed])
+                time.sleep(1)  # Redraw every second
+
+        with ThreadPoolExecutor(max_workers=MAX_PARALLEL) as executor:
+            while True:
+                started = time.monotonic()
+                all_statuses = poll_all(executor, PICO_IPS)
+                render_dashboard(all_statuses)
+                # Refresh every second
+                time.sleep(max(0.0, 1 - (time.monotonic() - started)))
 
     except KeyboardInterrupt:
         print("\nDashboard stopped.")
@@ -0,0 +1,197 @@
+# discovery.py
+# To be run on a computer (not the Pico)
+# Requires the 'requests' library: pip install requests
+# Finds the orchestra's devices so nobody has to hand-edit PICO_IPS: a UDP
+# DISCOVER beacon is broadcast on the command port and every device answers
+# with its id, address, API version and capabilities (see main.py). If nobody
+# answers (e.g. broadcasts are filtered), the local /24 is scanned for /health
+# in parallel instead. Results go into a small JSON registry on disk that
+# stays valid for REGISTRY_TTL_S, so restarts reuse it without waiting at all.
+#
+# Usage:
+#   python src/discovery.py                # cached devices, or discover them
+#   python src/discovery.py --refresh      # broadcast again, ignoring the cache
+#   python src/discovery.py --scan 192.168.10.0/24
+
+import argparse
+import ipaddress
+import json
+import os
+import random
+import socket
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+UDP_PORT = 5005            # device command port, which also answers beacons
+BEACON_ADDR = "255.255.255.255"
+BEACON_WAIT_S = 0.3        # replies are collected this long after the beacon
+BEACON_REPEATS = 2         # broadcasts are often dropped on Wi-Fi, so send twice
+SCAN_TIMEOUT_S = 0.3       # per-address /health timeout of the fallback scan
+SCAN_PARALLEL = 64         # addresses probed at once
+REGISTRY_FILE = ".pico_registry.json"
+REGISTRY_TTL_S = 600       # cached devices older than this are rediscovered
+
+# Wire format shared with main.py: magic b"PL", type, flags, seq (u32)
+UDP_HEADER = struct.Struct("<2sBBI")
+UDP_MAGIC = b"PL"
+UDP_TYPE_DISCOVER = 5
+UDP_TYPE_ACK = 0x80
+
+
+def device_address(info):
+    """The host[:port] string the conductor and dashboard put in PICO_IPS."""
+    port = info.get("http_port", 80)
+    return info["ip"] if port == 80 else f"{info['ip']}:{port}"
+
+
+# --- Beacon ---
+
+
+def beacon(port=UDP_PORT, addr=BEACON_ADDR, wait_s=BEACON_WAIT_S):
+    """Broadcasts DISCOVER and collects the replies -> {device_id: info}."""
+    seq = random.getrandbits(32)
+    packet = UDP_HEADER.pack(UDP_MAGIC, UDP_TYPE_DISCOVER, 0, seq)
+    found = {}
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        deadline = time.monotonic() + wait_s
+        for _ in range(BEACON_REPEATS):
+            try:
+                sock.sendto(packet, (addr, port))
+            except OSError as e:
+                print(f"Discovery beacon failed: {e}")
+                return found
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return found
+            sock.settimeout(remaining)
+            try:
+                data, (ip, _) = sock.recvfrom(1024)
+            except socket.timeout:
+                return found
+            if len(data) <= UDP_HEADER.size:
+                continue
+            magic, kind, _, reply_seq = UDP_HEADER.unpack_from(data)
+            if magic != UDP_MAGIC or kind != UDP_TYPE_ACK | UDP_TYPE_DISCOVER or reply_seq != seq:
+                continue
+            try:
+                info = json.loads(data[UDP_HEADER.size:])
+            except ValueError:
+                continue
+            info["ip"] = ip  # the address that answered is the one we can reach
+            found[info["device_id"]] = info
+
+
+# --- Subnet Scan ---
+
+
+def local_subnet():
+    """The /24 around this computer's outgoing interface address."""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        # Connecting a UDP socket sends nothing; it just picks the route
+        sock.connect(("8.8.8.8", 80))
+        ip = sock.getsockname()[0]
+    return ipaddress.ip_network(f"{ip}/24", strict=False)
+
+
+def probe_health(ip, timeout=SCAN_TIMEOUT_S):
+    """GET /health on one address -> device info, or None."""
+    try:
+        health = requests.get(f"http://{ip}/health", timeout=timeout).json()
+        return {
+            "device_id": health["device_id"],
+            "ip": str(ip),
+            "http_port": 80,
+            "api": health.get("api"),
+            "caps": [],
+        }
+    except (requests.exceptions.RequestException, ValueError, KeyError, TypeError):
+        return None
+
+
+def scan_subnet(subnet=None, timeout=SCAN_TIMEOUT_S):
+    """Probes every host of `subnet` (default: the local /24) -> {device_id: info}."""
+    network = ipaddress.ip_network(subnet, strict=False) if subnet else local_subnet()
+    found = {}
+    with ThreadPoolExecutor(max_workers=SCAN_PARALLEL) as executor:
+        for info in executor.map(lambda ip: probe_health(ip, timeout), network.hosts()):
+            if info is not None:
+                found[info["device_id"]] = info
+    return found
+
+
+# --- Registry ---
+
+
+def load_registry(path=REGISTRY_FILE, ttl_s=REGISTRY_TTL_S):
+    """Devices seen within the last `ttl_s` seconds -> {device_id: info}."""
+    try:
+        with open(path) as f:
+            devices = json.load(f)["devices"]
+    except (OSError, ValueError, KeyError):
+        return {}
+    now = time.time()
+    return {
+        device_id: info
+        for device_id, info in devices.items()
+        if now - info.get("seen", 0) < ttl_s
+    }
+
+
+def save_registry(found, path=REGISTRY_FILE, ttl_s=REGISTRY_TTL_S):
+    """Stamps `found` as seen now and merges it into the registry file."""
+    devices = load_registry(path, ttl_s)
+    now = time.time()
+    for device_id, info in found.items():
+        devices[device_id] = dict(info, seen=now)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"devices": devices}, f, indent=2)
+    os.replace(tmp, path)
+
+
+def find_devices(refresh=False, scan=True, subnet=None, path=REGISTRY_FILE,
+                 ttl_s=REGISTRY_TTL_S, port=UDP_PORT):
+    """Device addresses for PICO_IPS: from the fresh registry, else by beacon, else by scan."""
+    if not refresh:
+        cached = load_registry(path, ttl_s)
+        if cached:
+            return sorted(device_address(info) for info in cached.values())
+
+    started = time.monotonic()
+    found = beacon(port)
+    how = "beacon"
+    if not found and scan:
+        found = scan_subnet(subnet)
+        how = "subnet scan"
+    print(f"Discovered {len(found)} devices by {how} in "
+          f"{(time.monotonic() - started) * 1000:.0f} ms.")
+    if found:
+        save_registry(found, path, ttl_s)
+    return sorted(device_address(info) for info in found.values())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find Pico Light Orchestra devices")
+    parser.add_argument("--refresh", action="store_true", help="ignore the cached registry")
+    parser.add_argument("--scan", metavar="SUBNET", default=None,
+                        help="skip the beacon and scan this subnet (e.g. 192.168.10.0/24)")
+    parser.add_argument("--port", type=int, default=UDP_PORT, help="device UDP port")
+    args = parser.parse_args()
+
+    if args.scan:
+        found = scan_subnet(args.scan)
+        save_registry(found)
+    else:
+        find_devices(refresh=args.refresh, port=args.port)
+        found = load_registry()
+
+    print(f"{'Address':<22} {'Device ID':<18} {'API':<7} Capabilities")
+    print("-" * 70)
+    for info in sorted(found.values(), key=device_address):
+        print(f"{device_address(info):<22} {info['device_id']:<18} {info.get('api') or '-':<7} "
+              f"{', '.join(info.get('caps') or []) or '-'}")
@@ -1,12 +1,18 @@
 # main.py for Raspberry Pi Pico W
 # Title: Pico Light Orchestra Instrument Code
 
+import gc
 import machine
 import time
 import network
 import json
 import math
+import micropython
 import asyncio
+import _thread
+import socket
+import struct
+from array import array
 
 # --- Pin Configuration ---
 # The photosensor is connected to an Analog-to-Digital Converter (ADC) pin.
@@ -20,8 +26,74 @@ MAX_LIGHT = 60000       # expected bright threshold
 BASE_NOTE_HZ = 261.626     # C4 base frequency
 OCTAVES = 2                # two octaves
 SEMITONES_PER_OCTAVE = 12
-TOTAL_STEPS = OCTAVES * SEMITONES_PER_OCTAVE  # 24 semitones
+TOTAL_STEPS = OCTAVES * SEMITONES_PER_OCTAVE  # steps in the active scale (24 semitones)
 DUTY = 300                 # sound noise：0~65535
+NOTE_QUEUE_LEN = 64        # melody notes the device can hold ahead of playback
+PLAYLOG_LEN = 128          # note start times kept for skew measurement
+SCORE_MAX_NOTES = 256      # notes in one uploaded /score
+EVENT_INTERVAL_MS = 500    # /events sample period
+LIGHT_LOOP_MS = 50         # light-to-sound loop period
+SAMPLE_INTERVAL_MS = 50    # sensor sampler period (matches the light loop)
+DUAL_CORE = False          # note engine and ADC sampling on core 1 (see Dual-Core Mode)
+HISTORY_DECIMATE = 100     # samples averaged into one history entry (every 5 s)
+HISTORY_LEN = 2048         # history entries kept (~2.8 h at 5 s)
+
+# Signal conditioning between the ADC and the light loop (POST /filter)
+FILTER_MODES = ("none", "ema", "median")
+FILTER_MODE = "ema"        # smoothing applied to each oversampled reading
+OVERSAMPLE = 4             # ADC reads averaged into one sample
+EMA_SHIFT = 2              # EMA weight of a new sample = 1 / 2**EMA_SHIFT
+MEDIAN_N = 5               # window of the median filter (odd)
+MEDIAN_MAX = 9             # largest allowed MEDIAN_N
+HYSTERESIS = 0.25          # extra fraction of a step to cross before the note changes
+
+# On-device light range calibration (POST /calibrate)
+CALIBRATE_LOW = 0.10       # quantile that becomes MIN_LIGHT
+CALIBRATE_HIGH = 0.90      # quantile that becomes MAX_LIGHT
+CALIBRATE_MIN_SAMPLES = 20  # fewer samples than this are not applied
+CALIBRATE_MIN_SPAN = 1024  # nor is a range narrower than this (ADC counts)
+
+# Garbage collection during playback (see the Garbage Collection section)
+GC_IDLE_MIN_MS = 10        # shortest silence a collection is fitted into
+GC_IDLE_MIN_GARBAGE = 4096  # ... and only once this much was allocated since the last one
+GC_PRESSURE_BYTES = 16384  # free heap below which a collection is forced regardless
+
+# --- Network Constants ---
+BIND_HOST = "0.0.0.0"      # interface the servers listen on
+HTTP_PORT = 80             # device HTTP API
+UDP_PORT = 5005            # binary note commands, next to the HTTP server
+UDP_POLL_MS = 2            # receive poll period while the socket is idle
+MAX_EVENT_CLIENTS = 4      # concurrent /events streams
+
+# Scale degrees within one octave, as frequency ratios over the octave root.
+SCALES = {
+    "chromatic": [2 ** (i / 12) for i in range(12)],
+    "major": [2 ** (i / 12) for i in (0, 2, 4, 5, 7, 9, 11)],
+    "pentatonic": [2 ** (i / 12) for i in (0, 2, 4, 7, 9)],
+    "just": [1, 16 / 15, 9 / 8, 6 / 5, 5 / 4, 4 / 3, 45 / 32, 3 / 2, 8 / 5, 5 / 3, 9 / 5, 15 / 8],
+}
+SCALE = "chromatic"        # active entry of SCALES
+ADC_BUCKET_SHIFT = 6       # light table resolution: 65536 >> 6 = 1024 buckets
+
+# --- HTTP Server Constants ---
+API_VERSION = "1.0.0"
+# Features announced to discovery beacons, so hosts can tell firmware apart
+CAPABILITIES = (
+    "tone", "melody", "score", "udp", "timed", "events", "history",
+    "tuning", "filter", "calibrate", "playlog",
+)
+MAX_BODY_BYTES = 1024      # larger request bodies are rejected
+MAX_SCORE_BYTES = 8192     # ... except a whole-score upload to /score
+KEEPALIVE_IDLE_MS = 30000  # close a persistent connection after this much silence
+REQUEST_TIMEOUT_MS = 5000  # ... or once a started request takes longer than this to arrive
+SLOT_SWEEP_MS = 1000       # how often connections are checked against those limits
+
+# --- Wi-Fi Constants ---
+WIFI_CONNECT_TIMEOUT_MS = 10000  # give up on one association attempt after this
+WIFI_POLL_MS = 100               # status poll period while associating
+WIFI_CHECK_MS = 1000             # link check period once connected
+WIFI_BACKOFF_MIN_MS = 1000       # first retry delay after a failed attempt
+WIFI_BACKOFF_MAX_MS = 30000      # retry delay doubles up to this
 
 # The buzzer is connected to a GPIO pin that supports Pulse Width Modulation (PWM).
 # PWM allows us to create a square wave at a specific frequency to make a sound.
@@ -32,14 +104,23 @@ buzzer_pin = machine.PWM(machine.Pin(18))
 # This allows us to cancel it if a /stop request comes in.
 api_note_task = None
 api_lock_until_ms = 0  # Used to prohibit light control
+sequencer_task = None  # Background task that plays queued melody notes
+
+# Station interface; run_wifi_supervisor() associates it in the background
+wlan = network.WLAN(network.STA_IF)
+wifi_ifconfig = None   # (ip, netmask, gateway, dns) of the last association
+wifi_bssid = None      # access point we joined, so reconnects skip the scan
+wifi_channel = None    # its channel, for diagnostics
+wifi_reconnects = 0    # times the link dropped and was brought back
 
 # --- Core Functions ---
 
 
-def connect_to_wifi(wifi_config: str = "wifi_config.json"):
-    """Connects the Pico W to the specified Wi-Fi network.
+def load_wifi_config(wifi_config: str = "wifi_config.json"):
+    """Returns the Wi-Fi settings.
 
     This expects a JSON text file 'wifi_config.json' with 'ssid' and 'password' keys,
+    and optionally a fixed "ifconfig": [ip, netmask, gateway, dns] to skip DHCP,
     which would look like
     {
         "ssid": "your_wifi_ssid",
@@ -53,61 +134,620 @@ def connect_to_wifi(wifi_config: str = "wifi_config.json"):
 
     # with open(wifi_config, "r") as f:
       #  data = json.load(f)
-    global wlan
-    wlan = network.WLAN(network.STA_IF)
-    wlan.active(True)
-    wlan.connect(data["ssid"], data["password"])
+    return data
+
 
-    # Wait for connection or fail
-    max_wait = 10
+async def connect_to_wifi(data, fast=False):
+    """Joins the network without blocking the event loop; returns the IP or None.
+
+    With `fast`, the access point (BSSID) and address remembered from the last
+    association are reused, which skips the scan and the DHCP exchange.
+    """
+    wlan.active(True)
+    static = data.get("ifconfig")
+    if static:
+        wlan.ifconfig(tuple(static))
+    elif fast and wifi_ifconfig:
+        wlan.ifconfig(wifi_ifconfig)
+    elif wifi_ifconfig:
+        # A previous fast reconnect pinned the address; go back to DHCP
+        try:
+            wlan.ifconfig("dhcp")
+        except (OSError, TypeError, ValueError):
+            pass
     print("Connecting to Wi-Fi...")
-    while max_wait > 0:
-        if wlan.status() < 0 or wlan.status() >= 3:
+    try:
+        if fast and wifi_bssid:
+            wlan.connect(data["ssid"], data["password"], bssid=wifi_bssid)
+        else:
+            wlan.connect(data["ssid"], data["password"])
+    except (OSError, TypeError) as e:
+        print(f"Wi-Fi connect failed: {e}")
+        return None
+
+    # Poll instead of sleeping so the light loop and sampler keep running
+    deadline = time.ticks_add(time.ticks_ms(), WIFI_CONNECT_TIMEOUT_MS)
+    while time.ticks_diff(deadline, time.ticks_ms()) > 0:
+        status = wlan.status()
+        if status < 0 or status >= 3:
             break
-        max_wait -= 1
-        time.sleep(1)
+        await asyncio.sleep_ms(WIFI_POLL_MS)  # type: ignore[attr-defined]
 
-    if wlan.status() != 3:
-        raise RuntimeError("Network connection failed")
-    else:
-        status = wlan.ifconfig()
-        ip_address = status[0]
-        print(f"Connected! Pico IP Address: {ip_address}")
+    if not wlan.isconnected():
+        print(f"Wi-Fi connection failed (status {wlan.status()})")
+        wlan.disconnect()
+        return None
+    ip_address = wlan.ifconfig()[0]
+    print(f"Connected! Pico IP Address: {ip_address}")
     return ip_address
 
 
+def remember_association():
+    """Caches the address and the access point's BSSID/channel for fast reconnects.
+
+    Only the current link is queried: a scan would block the event loop for
+    seconds. Ports whose driver can't report the BSSID reuse the address only.
+    """
+    global wifi_ifconfig, wifi_bssid, wifi_channel
+    wifi_ifconfig = wlan.ifconfig()
+    try:
+        wifi_bssid = wlan.config("bssid")
+    except (ValueError, OSError, TypeError):
+        wifi_bssid = None
+    try:
+        wifi_channel = wlan.config("channel")
+    except (ValueError, OSError, TypeError):
+        wifi_channel = None
+
+
+async def start_servers():
+    """Binds the HTTP and UDP servers (once there is an IP to serve on)."""
+    await asyncio.start_server(handle_request, BIND_HOST, HTTP_PORT)
+    asyncio.create_task(run_slot_sweeper())
+    print(f"HTTP server started on port {HTTP_PORT}")
+    asyncio.create_task(run_udp_server(UDP_PORT))
+
+
+async def run_wifi_supervisor():
+    """Brings the network up in the background and keeps it up.
+
+    The servers are started after the first association. Whenever the link
+    drops, it reconnects with exponential backoff, trying the remembered
+    BSSID and address first and a full scan + DHCP if that fails.
+    """
+    global wifi_reconnects
+    data = load_wifi_config()
+    servers_started = False
+    backoff = WIFI_BACKOFF_MIN_MS
+    fast = False
+    while True:
+        if wlan.isconnected():
+            await asyncio.sleep_ms(WIFI_CHECK_MS)  # type: ignore[attr-defined]
+            continue
+
+        if servers_started:
+            wifi_reconnects += 1
+            print("Wi-Fi connection lost, reconnecting...")
+        ip = await connect_to_wifi(data, fast)
+        if ip is None:
+            # A stale BSSID/address may be the problem: next try starts clean
+            fast = False
+            await asyncio.sleep_ms(backoff)  # type: ignore[attr-defined]
+            backoff = min(backoff * 2, WIFI_BACKOFF_MAX_MS)
+            continue
+
+        backoff = WIFI_BACKOFF_MIN_MS
+        if not fast:
+            remember_association()
+        fast = True
+        if not servers_started:
+            try:
+                print(f"Starting web server on {ip}...")
+                await start_servers()
+                servers_started = True
+            except OSError as e:
+                print(f"Failed to start servers: {e}")
+
+
 def play_tone(frequency: int, duration_ms: int) -> None:
-    """Plays a tone on the buzzer for a given duration."""
-    if frequency > 0:
-        q_step = freq_to_nearest_step(float(frequency))
-        q_freq = int(step_to_freq(q_step))
-        buzzer_pin.freq(q_freq)
-        buzzer_pin.duty_u16(DUTY)
-        time.sleep_ms(duration_ms)  # type: ignore[attr-defined]
-        stop_tone()
-    else:
-        time.sleep_ms(duration_ms)  # type: ignore[attr-defined]
+    """Plays a tone on the buzzer for a given duration (blocking)."""
+    if frequency > 0 and engine_space():
+        q_freq = step_to_freq(freq_to_nearest_step(frequency))
+        engine_push(q_freq, DUTY, time.ticks_ms(), duration_ms)  # type: ignore[attr-defined]
+    time.sleep_ms(duration_ms)  # type: ignore[attr-defined]
 
 def stop_tone():
     """Stops any sound from playing."""
     buzzer_pin.duty_u16(0)  # 0% duty cycle means silence
 
 
-async def play_api_note(frequency, duration_s):
-    """Coroutine to play a note from an API call, can be cancelled."""
+def duty_to_u16(duty: float) -> int:
+    """API duty cycle (0.0..1.0, clipped) -> PWM duty_u16 value."""
+    return int(clamp(duty, 0.0, 1.0) * 65535)
+
+
+# --- Note Engine ---
+# A hardware timer (or core 1, see Dual-Core Mode) owns the buzzer while API
+# sound plays. The players (API
+# notes, the melody sequencer, the score) only append notes with absolute
+# start ticks to this ring buffer; engine_tick() runs every millisecond in
+# interrupt context, starts each note on its tick, shapes its attack and
+# release ramps and ends it on time, however busy the event loop is. The
+# interrupt handler only does small-int arithmetic on preallocated arrays
+# and writes the PWM, so it never allocates.
+ENGINE_LEN = 16            # notes buffered ahead of the timer (one slot stays empty)
+ENGINE_TICK_HZ = 1000      # timer rate: note boundaries land within 1 ms
+ENGINE_POLL_MS = 5         # players' poll period while the buffer is full
+ENGINE_RAMP_MAX_MS = 1000  # longest ramp (keeps duty * ms within a small int)
+ATTACK_MS = 0              # default duty ramp-up at the start of each note
+RELEASE_MS = 0             # default duty ramp-down at its end
+
+# eng_state values
+ENG_QUEUED = 0
+ENG_STARTED = 1            # reached the PWM at eng_started[i]
+ENG_MISSED = 2             # its whole span passed before the timer got to it
+
+micropython.alloc_emergency_exception_buf(100)
+
+eng_freq = array("H", [0] * ENGINE_LEN)      # PWM frequency (already quantized, > 0)
+eng_duty = array("H", [0] * ENGINE_LEN)      # peak duty_u16
+eng_start = array("I", [0] * ENGINE_LEN)     # ticks_ms start
+eng_ms = array("I", [0] * ENGINE_LEN)        # sounding length
+eng_attack = array("H", [0] * ENGINE_LEN)
+eng_release = array("H", [0] * ENGINE_LEN)
+eng_seq = array("I", [0] * ENGINE_LEN)       # play-log seq, never read by the interrupt
+eng_timed = bytearray(ENGINE_LEN)            # 1 if the sender chose the start tick
+eng_started = array("I", [0] * ENGINE_LEN)   # ticks_ms the note actually started
+eng_state = bytearray(ENGINE_LEN)
+eng_head = 0         # note sounding or next to start; only the timer advances it
+eng_tail = 0         # next free slot; only engine_push() advances it
+eng_log = 0          # next slot whose start is copied to the play log
+eng_sounding = False
+eng_level = 0        # duty last written by the timer
+engine_timer = None
+
+
+def engine_tick(timer):
+    """Timer interrupt: starts, ramps and ends the note at the head of the buffer."""
+    global eng_head, eng_sounding, eng_level
+    now = time.ticks_ms()
+    while eng_head != eng_tail:
+        i = eng_head
+        elapsed = time.ticks_diff(now, eng_start[i])
+        if elapsed < 0:
+            return
+        ms = eng_ms[i]
+        if elapsed >= ms:
+            # Note over (or missed altogether); the next one may start this tick
+            if not eng_sounding:
+                eng_state[i] = ENG_MISSED
+            eng_sounding = False
+            if eng_level:
+                buzzer_pin.duty_u16(0)
+                eng_level = 0
+            eng_head = (i + 1) % ENGINE_LEN
+            continue
+        if not eng_sounding:
+            eng_sounding = True
+            eng_started[i] = now
+            eng_state[i] = ENG_STARTED
+            buzzer_pin.freq(eng_freq[i])
+            eng_level = -1
+        peak = eng_duty[i]
+        if elapsed < eng_attack[i]:
+            level = peak * elapsed // eng_attack[i]
+        elif ms - elapsed < eng_release[i]:
+            level = peak * (ms - elapsed) // eng_release[i]
+        else:
+            level = peak
+        if level != eng_level:
+            buzzer_pin.duty_u16(level)
+            eng_level = level
+        return
+
+
+def start_engine():
+    """Starts the engine timer, as a hard interrupt where the port allows it."""
+    global engine_timer
+    engine_timer = machine.Timer()
+    try:
+        engine_timer.init(freq=ENGINE_TICK_HZ, mode=machine.Timer.PERIODIC,
+                          callback=engine_tick, hard=True)
+    except TypeError:
+        # Older ports only have soft timer callbacks, which wait for the VM
+        engine_timer.init(freq=ENGINE_TICK_HZ, mode=machine.Timer.PERIODIC,
+                          callback=engine_tick)
+
+
+def engine_space():
+    """Free slots in the engine buffer."""
+    return (eng_head - eng_tail - 1) % ENGINE_LEN
+
+
+def engine_busy():
+    """True while the engine holds a note that has not finished."""
+    return eng_head != eng_tail
+
+
+def engine_push(freq, duty, start, ms, attack=ATTACK_MS, release=RELEASE_MS, seq=0, timed=False):
+    """Appends one note (freq > 0) starting at tick `start`; the caller checks engine_space()."""
+    global eng_tail
+    engine_collect_log()
+    i = eng_tail
+    eng_freq[i] = freq
+    eng_duty[i] = duty
+    eng_start[i] = start
+    eng_ms[i] = ms
+    eng_attack[i] = min(attack, ENGINE_RAMP_MAX_MS)
+    eng_release[i] = min(release, ENGINE_RAMP_MAX_MS)
+    eng_seq[i] = seq & 0xFFFFFFFF
+    eng_timed[i] = timed
+    eng_state[i] = ENG_QUEUED
+    state = engine_lock_acquire()
+    eng_tail = (i + 1) % ENGINE_LEN  # publishes the note to the timer
+    engine_lock_release(state)
+
+
+def engine_flush():
+    """Drops every buffered note and silences the buzzer."""
+    global eng_head, eng_sounding, eng_level, eng_log
+    engine_collect_log()
+    state = engine_lock_acquire()
+    eng_head = eng_tail
+    eng_sounding = False
+    eng_level = 0
+    stop_tone()
+    engine_lock_release(state)
+    eng_log = eng_tail
+
+
+def engine_lock_acquire():
+    """Keeps engine_tick() off the buffer: masks the timer, or locks out core 1."""
+    if core1_running:
+        engine_lock.acquire()
+        return 0
+    return machine.disable_irq()
+
+
+def engine_lock_release(state):
+    if core1_running:
+        engine_lock.release()
+    else:
+        machine.enable_irq(state)
+
+
+def engine_collect_log():
+    """Copies the starts the timer made into the play log and lateness counters."""
+    global eng_log
+    while eng_log != eng_tail:
+        i = eng_log
+        state = eng_state[i]
+        if state == ENG_QUEUED:
+            return
+        if state == ENG_STARTED:
+            log_note_start(eng_seq[i], eng_started[i])
+            if eng_timed[i]:
+                record_note_start(time.ticks_diff(eng_started[i], eng_start[i]))
+        eng_log = (i + 1) % ENGINE_LEN
+
+
+def engine_silence_ms():
+    """How long the buzzer stays silent from now on (0 while a note sounds)."""
+    if eng_sounding or eng_head == eng_tail:
+        return 0
+    return max(0, time.ticks_diff(eng_start[eng_head], time.ticks_ms()))
+
+
+async def engine_wait(free=ENGINE_LEN - 1):
+    """Waits for `free` empty slots (by default until every note has finished).
+
+    Silences the engine announces in the meantime are used for garbage collection.
+    """
+    while engine_space() < free:
+        engine_collect_log()
+        idle_collect(engine_silence_ms())
+        await asyncio.sleep_ms(ENGINE_POLL_MS)  # type: ignore[attr-defined]
+
+
+async def play_api_note(frequency, duration_s, duty=None, seq=0,
+                        attack=ATTACK_MS, release=RELEASE_MS):
+    """Coroutine to play a note from an API call, can be cancelled.
+
+    The note engine times the note; the task lasts as long as it sounds.
+    """
+    gc_hold()
     try:
         print(f"API playing note: {frequency}Hz for {duration_s}s")
         extend_api_lock(duration_s * 1000 + 2000)
-        q_step = freq_to_nearest_step(float(frequency))
-        q_freq = int(step_to_freq(q_step))
-        buzzer_pin.freq(q_freq)
-        buzzer_pin.duty_u16(DUTY)
-        await asyncio.sleep(duration_s)
-        stop_tone()
+        ms = int(duration_s * 1000)
+        if frequency > 0:
+            q_freq = step_to_freq(freq_to_nearest_step(frequency))
+            await engine_wait(1)  # a slot, in case scheduled notes fill the buffer
+            engine_push(q_freq, DUTY if duty is None else duty, time.ticks_ms(), ms,
+                        attack, release, seq)
+            await engine_wait()
+        else:
+            await asyncio.sleep_ms(ms)  # type: ignore[attr-defined]
         print("API note finished.")
     except asyncio.CancelledError:
-        stop_tone()
         print("API note cancelled.")
+    finally:
+        gc_release()
+
+
+# --- Dual-Core Mode ---
+# With DUAL_CORE the RP2040's second core runs core1_main() instead of the
+# engine timer: it ticks the note engine and takes the ADC readings, while
+# core 0 keeps networking, JSON and the light loop. The cores only meet in
+# two preallocated rings, each guarded by a lock: the note engine buffer
+# (core 0 appends, core 1 plays) and the sample ring below (core 1 appends,
+# run_sensor_sampler() drains it). Core 1 never allocates, so it keeps
+# running straight through core 0's garbage collections.
+CORE1_TICK_US = 500        # core 1 loop period: engine ticks land within 0.5 ms
+SAMPLE_RING_LEN = 16       # readings core 0 may fall behind by before the oldest drop
+
+engine_lock = _thread.allocate_lock()
+sample_lock = _thread.allocate_lock()
+sample_ring_raw = array("H", [0] * SAMPLE_RING_LEN)
+sample_ring_ticks = array("I", [0] * SAMPLE_RING_LEN)
+sample_head = 0      # oldest unread reading
+sample_count = 0     # readings waiting
+samples_dropped = 0  # readings overwritten before core 0 read them
+core1_running = False
+
+
+def push_sample(raw, ticks):
+    """Core 1: appends one reading, overwriting the oldest when core 0 lags."""
+    global sample_head, sample_count, samples_dropped
+    sample_lock.acquire()
+    i = (sample_head + sample_count) % SAMPLE_RING_LEN
+    sample_ring_raw[i] = raw
+    sample_ring_ticks[i] = ticks
+    if sample_count == SAMPLE_RING_LEN:
+        sample_head = (sample_head + 1) % SAMPLE_RING_LEN
+        samples_dropped += 1
+    else:
+        sample_count += 1
+    sample_lock.release()
+
+
+def take_samples(raws, ticks):
+    """Core 0: moves the waiting readings into raws/ticks; returns how many."""
+    global sample_head, sample_count
+    sample_lock.acquire()
+    n = sample_count
+    for k in range(n):
+        i = (sample_head + k) % SAMPLE_RING_LEN
+        raws[k] = sample_ring_raw[i]
+        ticks[k] = sample_ring_ticks[i]
+    sample_head = (sample_head + n) % SAMPLE_RING_LEN
+    sample_count = 0
+    sample_lock.release()
+    return n
+
+
+def core1_main():
+    """Core 1: a note engine tick every CORE1_TICK_US, an ADC reading every SAMPLE_INTERVAL_MS."""
+    next_sample = time.ticks_ms()
+    while core1_running:
+        engine_lock.acquire()
+        engine_tick(None)
+        engine_lock.release()
+        now = time.ticks_ms()
+        if time.ticks_diff(now, next_sample) >= 0:
+            push_sample(read_oversampled(), now)
+            next_sample = time.ticks_add(next_sample, SAMPLE_INTERVAL_MS)
+            if time.ticks_diff(now, next_sample) >= 0:
+                next_sample = time.ticks_add(now, SAMPLE_INTERVAL_MS)  # fell behind: resync
+        time.sleep_us(CORE1_TICK_US)  # type: ignore[attr-defined]
+
+
+def start_core1():
+    global core1_running
+    core1_running = True
+    _thread.start_new_thread(core1_main, ())
+
+
+# --- Play Log ---
+# The ticks_ms at which each API note actually reached the PWM, tagged with
+# the sender's note sequence number (0 if it sent none). GET /playlog serves
+# it so the conductor can measure per-note skew across devices.
+playlog_seq = array("I", [0] * PLAYLOG_LEN)
+playlog_ticks = array("I", [0] * PLAYLOG_LEN)
+playlog_head = 0
+playlog_count = 0
+
+
+def log_note_start(seq, ticks):
+    global playlog_head, playlog_count
+    playlog_seq[playlog_head] = seq & 0xFFFFFFFF
+    playlog_ticks[playlog_head] = ticks
+    playlog_head = (playlog_head + 1) % PLAYLOG_LEN
+    if playlog_count < PLAYLOG_LEN:
+        playlog_count += 1
+
+
+# --- Melody Sequencer ---
+# /melody only validates and enqueues; run_sequencer() drains this bounded
+# ring buffer in the background into the note engine. Each slot holds one
+# note plus the silent gap that follows it, and optionally an absolute start
+# time: timed notes wait in the buffer (a jitter buffer) until they fit in
+# the engine, which then starts them on their ticks_ms.
+queue_freq = array("H", [0] * NOTE_QUEUE_LEN)
+queue_ms = array("H", [0] * NOTE_QUEUE_LEN)
+queue_gap = array("H", [0] * NOTE_QUEUE_LEN)
+queue_duty = array("H", [0] * NOTE_QUEUE_LEN)
+queue_attack = array("H", [0] * NOTE_QUEUE_LEN)
+queue_release = array("H", [0] * NOTE_QUEUE_LEN)
+queue_at = array("I", [0] * NOTE_QUEUE_LEN)     # device ticks_ms start time
+queue_timed = bytearray(NOTE_QUEUE_LEN)          # 1 if queue_at applies
+queue_seq = array("I", [0] * NOTE_QUEUE_LEN)    # sender's note sequence number
+queue_head = 0       # index of the next note to play
+queue_depth = 0      # notes waiting in the buffer
+melody_pos = 0       # notes handed to the engine since the queue was last flushed
+melody_total = 0     # notes enqueued since the queue was last flushed
+sequencer_busy = False
+note_ready = asyncio.Event()
+
+
+def enqueue_note(freq, ms, gap_ms, duty, at=None, seq=0, attack=ATTACK_MS, release=RELEASE_MS):
+    """Appends one note to the ring buffer; the caller checks for room first."""
+    global queue_depth, melody_total
+    i = (queue_head + queue_depth) % NOTE_QUEUE_LEN
+    queue_freq[i] = freq
+    queue_ms[i] = ms
+    queue_gap[i] = gap_ms
+    queue_duty[i] = duty
+    queue_attack[i] = min(attack, ENGINE_RAMP_MAX_MS)
+    queue_release[i] = min(release, ENGINE_RAMP_MAX_MS)
+    queue_timed[i] = at is not None
+    queue_at[i] = (at or 0) & 0xFFFFFFFF
+    queue_seq[i] = seq & 0xFFFFFFFF
+    queue_depth += 1
+    melody_total += 1
+    note_ready.set()
+
+
+def flush_queue():
+    """Drops every queued note and silences the one currently playing."""
+    global queue_depth, melody_pos, melody_total, sequencer_task
+    queue_depth = 0
+    melody_pos = 0
+    melody_total = 0
+    engine_flush()
+    if sequencer_busy and sequencer_task is not None:
+        sequencer_task.cancel()
+        sequencer_task = asyncio.create_task(run_sequencer())
+
+
+async def run_sequencer():
+    """Feeds queued notes to the note engine for as long as the device runs.
+
+    An untimed note starts where the previous note's gap ends on the engine's
+    clock, so a phrase keeps its rhythm even when this task runs late.
+    """
+    global queue_head, queue_depth, melody_pos, sequencer_busy
+    next_start = 0  # tick at which the previous note's gap ends
+    try:
+        while True:
+            if queue_depth == 0:
+                if engine_busy():
+                    # The phrase's tail is still buffered; appended notes join it
+                    engine_collect_log()
+                    idle_collect(engine_silence_ms())
+                    await asyncio.sleep_ms(ENGINE_POLL_MS)  # type: ignore[attr-defined]
+                    continue
+                if sequencer_busy:
+                    sequencer_busy = False
+                    gc_release()
+                note_ready.clear()
+                await note_ready.wait()
+                continue
+            if not engine_space():
+                await engine_wait(1)
+                continue
+
+            i = queue_head
+            freq = queue_freq[i]
+            ms = queue_ms[i]
+            gap_ms = queue_gap[i]
+            queue_head = (i + 1) % NOTE_QUEUE_LEN
+            queue_depth -= 1
+            melody_pos += 1
+
+            now = time.ticks_ms()
+            if queue_timed[i]:
+                start = queue_at[i]
+            elif sequencer_busy and time.ticks_diff(next_start, now) > 0:
+                start = next_start
+            else:
+                start = now
+            next_start = time.ticks_add(start, ms + gap_ms)
+            if not sequencer_busy:
+                sequencer_busy = True
+                gc_hold()
+            extend_api_lock(max(0, time.ticks_diff(next_start, now)) + 2000)
+            if freq > 0 and ms > 0:
+                engine_push(step_to_freq(freq_to_nearest_step(freq)), queue_duty[i], start, ms,
+                            queue_attack[i], queue_release[i], queue_seq[i], queue_timed[i])
+    finally:
+        if sequencer_busy:
+            sequencer_busy = False
+            gc_release()
+
+
+# --- Score Player ---
+# POST /score stores a whole song with pitches already resolved to PWM
+# frequencies; run_score() then hands it to the note engine against
+# absolute ticks measured from one start tick, so timing never accumulates
+# drift and needs no traffic.
+score_freq = array("H", [0] * SCORE_MAX_NOTES)   # 0 = rest
+score_ms = array("H", [0] * SCORE_MAX_NOTES)
+score_duty = array("H", [0] * SCORE_MAX_NOTES)
+score_len = 0
+score_gap_ms = 0        # silence at the end of every note
+score_attack = ATTACK_MS
+score_release = RELEASE_MS
+score_seq_base = 0      # play-log seq of the first note
+score_task = None
+
+
+def score_duration_ms():
+    total = 0
+    for k in range(score_len):
+        total += score_ms[k]
+    return total
+
+
+async def run_score(start):
+    """Plays the stored score from device tick `start`."""
+    t = start
+    extend_api_lock(max(0, time.ticks_diff(start, time.ticks_ms())) + score_duration_ms() + 2000)
+    gc_hold()
+    try:
+        for k in range(score_len):
+            freq = score_freq[k]
+            ms = score_ms[k]
+            if freq:
+                if not engine_space():
+                    await engine_wait(1)
+                sound_ms = ms - score_gap_ms if score_gap_ms < ms else ms
+                engine_push(freq, score_duty[k], t, sound_ms, score_attack, score_release,
+                            score_seq_base + k, True)
+            t = time.ticks_add(t, ms)
+        await engine_wait()
+    finally:
+        gc_release()
+
+
+def start_score(at=None):
+    """Starts the stored score now, or at device tick `at`; returns the start tick."""
+    global score_task
+    cancel_api_sound()
+    start = time.ticks_ms() if at is None else at
+    score_task = asyncio.create_task(run_score(start))
+    return start
+
+
+def api_sound_active():
+    """True while an API note, a queued melody or a score owns the buzzer."""
+    if sequencer_busy or engine_busy():
+        return True
+    if score_task is not None and not score_task.done():
+        return True
+    return api_note_task is not None and not api_note_task.done()
+
+
+def cancel_api_sound():
+    """Stops any API note or score and flushes the melody queue."""
+    global api_note_task, score_task
+    if api_note_task:
+        api_note_task.cancel()
+        api_note_task = None
+    if score_task:
+        score_task.cancel()
+        score_task = None
+    flush_queue()
 
 
 def map_value(x, in_min, in_max, out_min, out_max):
@@ -121,75 +761,495 @@ def get_device_id():
     uid = machine.unique_id()  # bytes
     return ''.join('{:02x}'.format(b) for b in uid)
 
+
+DEVICE_ID = get_device_id()  # fixed for the life of the board, hex it once
+
 def extend_api_lock(ms):
     """Extend the suppression window by ms milliseconds (from the current time)"""
     global api_lock_until_ms
     api_lock_until_ms = time.ticks_add(time.ticks_ms(), int(ms))
 
-def step_to_freq(step: int) -> float:
-    """Semitones -> Frequency"""
+# --- Pitch Lookup Tables ---
+# Built once from the tuning constants so the light loop and API notes only
+# index into them; call set_tuning() to change a constant and rebuild.
+step_freqs = array("H")      # step -> PWM frequency (Hz)
+step_bounds = array("H")     # sorted freq boundaries between adjacent steps
+light_steps = bytearray(0)   # ADC bucket -> step
+
+
+def build_pitch_tables(scale, base_hz, octaves, min_light, max_light):
+    """Builds the step/frequency/light tables for a scale and range.
+
+    Returns (step_freqs, step_bounds, light_steps, total_steps) without
+    touching the active tables; raises ValueError for a tuning they can't hold.
+    """
+    if scale not in SCALES:
+        raise ValueError("Unknown scale")
+    if not base_hz >= 1:
+        raise ValueError("Base frequency out of range")
+    # Every step is a 16-bit PWM frequency
+    if not 1 <= octaves <= 16 or base_hz * (2 ** octaves) > 65535:
+        raise ValueError("Octaves out of range")
+    if not 0 <= min_light < max_light <= 65535:
+        raise ValueError("Light range out of range")
+
+    ratios = SCALES[scale]
+    freqs = [base_hz * (2 ** octave) * r for octave in range(octaves) for r in ratios]
+    freqs.append(base_hz * (2 ** octaves))
+    total = len(freqs) - 1
+
+    freq_table = array("H", [int(f) for f in freqs])
+    # Geometric midpoints (rounded up so integer Hz snap exactly as before)
+    bound_table = array("H", [math.ceil(math.sqrt(freqs[i] * freqs[i + 1]))
+                              for i in range(total)])
+
+    buckets = 65536 >> ADC_BUCKET_SHIFT
+    half = 1 << (ADC_BUCKET_SHIFT - 1)
+    light_table = bytearray(buckets)
+    for b in range(buckets):
+        clamped = clamp((b << ADC_BUCKET_SHIFT) + half, min_light, max_light)
+        t = (clamped - min_light) / (max_light - min_light)  # 0..1
+        light_table[b] = round(t * total)
+    return freq_table, bound_table, light_table, total
+
+
+def set_tuning(scale=None, base_hz=None, octaves=None, min_light=None, max_light=None):
+    """Changes any tuning constant and rebuilds the lookup tables.
+
+    The new tuning is checked and built first, so a rejected one (ValueError)
+    leaves the active constants and tables as they were.
+    """
+    global SCALE, BASE_NOTE_HZ, OCTAVES, MIN_LIGHT, MAX_LIGHT
+    global step_freqs, step_bounds, light_steps, TOTAL_STEPS
+    scale = SCALE if scale is None else scale
+    base_hz = BASE_NOTE_HZ if base_hz is None else float(base_hz)
+    octaves = OCTAVES if octaves is None else int(octaves)
+    min_light = MIN_LIGHT if min_light is None else int(min_light)
+    max_light = MAX_LIGHT if max_light is None else int(max_light)
+    tables = build_pitch_tables(scale, base_hz, octaves, min_light, max_light)
+
+    step_freqs, step_bounds, light_steps, TOTAL_STEPS = tables
+    SCALE = scale
+    BASE_NOTE_HZ = base_hz
+    OCTAVES = octaves
+    MIN_LIGHT = min_light
+    MAX_LIGHT = max_light
+
+
+def step_to_freq(step: int) -> int:
+    """Scale step -> PWM frequency, clamped to 0..TOTAL_STEPS"""
     if step < 0:
         step = 0
     elif step > TOTAL_STEPS:
         step = TOTAL_STEPS
-    return BASE_NOTE_HZ * (2 ** (step / 12.0))
+    return step_freqs[step]
+
 
 def freq_to_nearest_step(freq: float) -> int:
-    """Any frequency -> steps to the nearest semitone (relative to C4), clamped to 0..TOTAL_STEPS"""
-    if freq <= 0:
-        return 0
-    semi = round(12.0 * (math.log(freq / BASE_NOTE_HZ) / math.log(2.0)))
-    if semi < 0:
-        semi = 0
-    elif semi > TOTAL_STEPS:
-        semi = TOTAL_STEPS
-    return int(semi)
+    """Any frequency -> nearest step of the active scale, by bisecting step_bounds"""
+    lo = 0
+    hi = TOTAL_STEPS
+    while lo < hi:
+        mid = (lo + hi) >> 1
+        if freq < step_bounds[mid]:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
 
-def light_to_nearest_step(raw_adc: int) -> int:
-    """ADC raw value -> nearest semitone step (linearly mapped to 0..TOTAL_STEPS and rounded)"""
-    clamped = clamp(raw_adc, MIN_LIGHT, MAX_LIGHT)
+
+def light_norm(raw_adc: int) -> float:
+    """ADC raw value -> 0.0..1.0 within the calibrated light range"""
     if MAX_LIGHT == MIN_LIGHT:
-        return 0
-    t = (clamped - MIN_LIGHT) / (MAX_LIGHT - MIN_LIGHT)  # 0..1
-    step = round(t * TOTAL_STEPS)  # 0..24
-    if step < 0:
-        step = 0
-    elif step > TOTAL_STEPS:
-        step = TOTAL_STEPS
-    return int(step)
+        return 0.0
+    return (clamp(raw_adc, MIN_LIGHT, MAX_LIGHT) - MIN_LIGHT) / (MAX_LIGHT - MIN_LIGHT)
 
 
-async def handle_request(reader, writer):
-    """Handles incoming HTTP requests."""
-    global api_note_task
+def light_to_nearest_step(raw_adc: int) -> int:
+    """ADC raw value -> nearest step (linearly mapped to 0..TOTAL_STEPS)"""
+    return light_steps[raw_adc >> ADC_BUCKET_SHIFT]
 
-    print("Client connected")
-    request_line = await reader.readline()
-    # Skip headers
-    while await reader.readline() != b"\r\n":
-        pass
 
+set_tuning()
+
+
+# --- Request Parsing ---
+# Every connection borrows one of MAX_CONNECTIONS preallocated slots and reads
+# its requests straight into the slot's buffer with readinto(). The request
+# line and headers are matched byte by byte in place, nothing is decoded or
+# split, so a request without a body or query string allocates nothing. Only
+# a /score upload larger than the slot goes to the shared score buffer.
+MAX_CONNECTIONS = 8        # concurrent HTTP connections (one buffer each)
+REQUEST_BUF_BYTES = 1536   # request line + headers + a MAX_BODY_BYTES body
+
+# read() results
+REQ_OK = 0
+REQ_CLOSED = 1             # client closed the connection or went idle
+REQ_BAD = 2                # malformed, or headers larger than the buffer
+REQ_TOO_LARGE = 3          # Content-Length over the route's limit
+
+score_buf = bytearray(MAX_SCORE_BYTES)
+score_mv = memoryview(score_buf)
+score_buf_busy = False
+
+
+@micropython.native
+def find_byte(buf, start, end, byte):
+    """Index of the first `byte` in buf[start:end], or -1."""
+    i = start
+    while i < end:
+        if buf[i] == byte:
+            return i
+        i += 1
+    return -1
+
+
+@micropython.native
+def find_header_end(buf, start, end):
+    """Index of the blank line's CR in buf[start:end], or -1."""
+    i = start
+    while i + 3 < end:
+        if buf[i] == 13 and buf[i + 1] == 10 and buf[i + 2] == 13 and buf[i + 3] == 10:
+            return i
+        i += 1
+    return -1
+
+
+@micropython.native
+def match_bytes(buf, pos, end, token):
+    """True if buf[pos:end] starts with token."""
+    n = len(token)
+    if pos + n > end:
+        return False
+    for i in range(n):
+        if buf[pos + i] != token[i]:
+            return False
+    return True
+
+
+@micropython.native
+def match_lower(buf, pos, end, token):
+    """match_bytes() ignoring ASCII case; token must be lowercase."""
+    n = len(token)
+    if pos + n > end:
+        return False
+    for i in range(n):
+        if buf[pos + i] | 0x20 != token[i]:
+            return False
+    return True
+
+
+@micropython.native
+def parse_uint(buf, pos, end):
+    """Decimal value of buf[pos:end] around optional spaces, or -1."""
+    while pos < end and buf[pos] == 32:
+        pos += 1
+    value = 0
+    digits = 0
+    while pos < end and 48 <= buf[pos] <= 57:
+        value = value * 10 + buf[pos] - 48
+        pos += 1
+        digits += 1
+    while pos < end and buf[pos] in (13, 32):
+        pos += 1
+    return value if digits and pos == end else -1
+
+
+def match_route(buf, method_end, path_start, path_end):
+    """Route number of the method and path at the start of buf."""
+    path_len = path_end - path_start
+    for route in range(len(ROUTE_KEYS)):
+        method, path = ROUTE_KEYS[route]
+        if (len(path) == path_len and len(method) == method_end
+                and match_bytes(buf, path_start, path_end, path)
+                and match_bytes(buf, 0, method_end, method)):
+            return route
+    return OTHER_ROUTE
+
+
+class RequestSlot:
+    """A connection's request buffer and the parse of its current request."""
+
+    def __init__(self):
+        self.buf = bytearray(REQUEST_BUF_BYTES)
+        self.mv = memoryview(self.buf)
+        self.busy = False
+        self.filled = 0        # bytes in buf, maybe including a pipelined request
+        self.used = 0          # bytes of buf taken by the current request
+        self.route = 0
+        self.keep_alive = True
+        self.query_start = 0
+        self.query_end = 0
+        self.body_start = 0
+        self.body_len = 0
+        self.in_score_buf = False
+        self.task = None       # the connection's handler, cancelled by the sweeper
+        self.deadline = None   # ticks_ms the read in progress must finish by
+
+    async def read(self, reader):
+        """Reads and parses the next request; returns one of the REQ_* results.
+
+        Sets self.deadline for run_slot_sweeper(): KEEPALIVE_IDLE_MS for the
+        request's first byte, then REQUEST_TIMEOUT_MS for the whole request.
+        The caller clears it once the request is in.
+        """
+        global score_buf_busy
+        buf = self.buf
+        self.deadline = time.ticks_add(
+            time.ticks_ms(), REQUEST_TIMEOUT_MS if self.filled else KEEPALIVE_IDLE_MS
+        )
+        scan = 0
+        while True:
+            end = find_header_end(buf, scan, self.filled)
+            if end >= 0:
+                break
+            if self.filled == REQUEST_BUF_BYTES:
+                return REQ_BAD
+            scan = max(0, self.filled - 3)
+            if self.filled:
+                n = await reader.readinto(self.mv[self.filled:])
+            else:
+                n = await reader.readinto(self.mv)
+                self.deadline = time.ticks_add(time.ticks_ms(), REQUEST_TIMEOUT_MS)
+            if not n:
+                return REQ_BAD if self.filled else REQ_CLOSED
+            self.filled += n
+
+        # Request line: METHOD SP path[?query] SP HTTP/1.x CRLF
+        line_end = find_byte(buf, 0, end + 2, 10)
+        method_end = find_byte(buf, 0, line_end, 32)
+        target_end = find_byte(buf, method_end + 1, line_end, 32)
+        if method_end <= 0 or target_end < 0:
+            return REQ_BAD
+        path_end = find_byte(buf, method_end + 1, target_end, 63)  # "?"
+        if path_end < 0:
+            path_end = self.query_start = self.query_end = target_end
+        else:
+            self.query_start = path_end + 1
+            self.query_end = target_end
+        self.route = match_route(buf, method_end, method_end + 1, path_end)
+        self.keep_alive = match_bytes(buf, target_end + 1, line_end, b"HTTP/1.1")
+
+        # Only Content-Length and Connection matter; every other header is skipped
+        content_length = 0
+        pos = line_end + 1
+        while pos < end + 2:
+            eol = find_byte(buf, pos, end + 2, 10)
+            if match_lower(buf, pos, eol, b"content-length:"):
+                content_length = parse_uint(buf, pos + 15, eol)
+                if content_length < 0:
+                    return REQ_BAD
+            elif match_lower(buf, pos, eol, b"connection:"):
+                pos += 11
+                while pos < eol and buf[pos] == 32:
+                    pos += 1
+                if match_lower(buf, pos, eol, b"close"):
+                    self.keep_alive = False
+                elif match_lower(buf, pos, eol, b"keep-alive"):
+                    self.keep_alive = True
+            pos = eol + 1
+
+        # Refuse an oversized body before reading any of it
+        if content_length > (MAX_SCORE_BYTES if self.route == SCORE_ROUTE else MAX_BODY_BYTES):
+            return REQ_TOO_LARGE
+        self.body_start = end + 4
+        self.body_len = content_length
+        need = self.body_start + content_length
+        if need <= REQUEST_BUF_BYTES:
+            while self.filled < need:
+                n = await reader.readinto(self.mv[self.filled:])
+                if not n:
+                    return REQ_BAD
+                self.filled += n
+            self.used = need
+            return REQ_OK
+
+        # A score larger than the slot continues in the shared score buffer
+        if score_buf_busy:
+            return REQ_TOO_LARGE
+        score_buf_busy = self.in_score_buf = True
+        got = self.filled - self.body_start
+        score_mv[:got] = self.mv[self.body_start:self.filled]
+        while got < content_length:
+            n = await reader.readinto(score_mv[got:content_length])
+            if not n:
+                return REQ_BAD
+            got += n
+        self.used = self.filled
+        return REQ_OK
+
+    def body(self):
+        if not self.body_len:
+            return b""
+        if self.in_score_buf:
+            return score_mv[:self.body_len]
+        return self.mv[self.body_start:self.body_start + self.body_len]
+
+    def query(self):
+        if self.query_start == self.query_end:
+            return ""
+        return str(self.mv[self.query_start:self.query_end], "utf-8")
+
+    def next_request(self):
+        """Drops the current request, keeping any pipelined bytes behind it."""
+        global score_buf_busy
+        if self.in_score_buf:
+            score_buf_busy = self.in_score_buf = False
+        buf = self.buf
+        rest = self.filled - self.used
+        for i in range(rest):
+            buf[i] = buf[self.used + i]
+        self.filled = rest
+        self.used = 0
+
+    def release(self):
+        self.next_request()
+        self.filled = 0
+        self.deadline = None
+        self.task = None
+        self.busy = False
+
+
+request_slots = [RequestSlot() for _ in range(MAX_CONNECTIONS)]
+
+
+async def run_slot_sweeper():
+    """Closes connections whose client went quiet or stalled mid-request.
+
+    One task checks every slot's deadline, instead of a timeout task per read.
+    """
+    while True:
+        await asyncio.sleep_ms(SLOT_SWEEP_MS)  # type: ignore[attr-defined]
+        now = time.ticks_ms()
+        for slot in request_slots:
+            if slot.deadline is not None and time.ticks_diff(now, slot.deadline) >= 0:
+                slot.deadline = None
+                slot.task.cancel()
+
+
+def acquire_slot():
+    """A free RequestSlot, or None when MAX_CONNECTIONS are open."""
+    for slot in request_slots:
+        if not slot.busy:
+            slot.busy = True
+            return slot
+    return None
+
+
+# --- Response Encoding ---
+# Every reply goes out as one pre-framed bytes object. Constant replies are
+# encoded once at boot in both connection flavours and indexed by keep_alive.
+CONNECTION_HEADER = (b"Connection: close\r\n\r\n", b"Connection: keep-alive\r\n\r\n")
+
+
+def encode_head(status_line, content_type):
+    """Status line + Content-Type header, encoded once."""
+    return f"HTTP/1.1 {status_line}\r\nContent-Type: {content_type}\r\n".encode("utf-8")
+
+
+HEAD_200_JSON = encode_head("200 OK", "application/json")
+HEAD_200_HTML = encode_head("200 OK", "text/html")
+HEAD_200_BINARY = encode_head("200 OK", "application/octet-stream")
+HEAD_200_METRICS = encode_head("200 OK", "text/plain; version=0.0.4")
+HEAD_202_JSON = encode_head("202 Accepted", "application/json")
+HEAD_400_JSON = encode_head("400 Bad Request", "application/json")
+HEAD_404_JSON = encode_head("404 Not Found", "application/json")
+HEAD_413_JSON = encode_head("413 Payload Too Large", "application/json")
+HEAD_503_JSON = encode_head("503 Service Unavailable", "application/json")
+
+
+def make_reply(head, body, keep_alive):
+    """Frames an encoded body behind a pre-encoded head."""
+    return b"".join((
+        head, b"Content-Length: %d\r\n" % len(body), CONNECTION_HEADER[keep_alive], body
+    ))
+
+
+def static_reply(head, response):
+    """Pre-encodes a constant reply as a (close, keep-alive) pair."""
+    body = response.encode("utf-8")
+    return make_reply(head, body, False), make_reply(head, body, True)
+
+
+BAD_REQUEST = static_reply(HEAD_400_JSON, '{"error": "Bad request"}')
+BAD_JSON = static_reply(HEAD_400_JSON, '{"error": "Invalid JSON"}')
+NOT_FOUND = static_reply(HEAD_404_JSON, '{"error": "Not found"}')
+TOO_LARGE = static_reply(HEAD_413_JSON, '{"error": "Body too large"}')
+SERVER_BUSY = static_reply(HEAD_503_JSON, '{"error": "Too many connections"}')
+QUEUE_FULL = static_reply(HEAD_503_JSON, '{"error": "Note queue full"}')
+NO_SCORE = static_reply(HEAD_404_JSON, '{"error": "No score uploaded"}')
+PLAY_NOTE_OK = static_reply(
+    HEAD_200_JSON, '{"status": "ok", "message": "Note playing started."}'
+)
+TONE_SCHEDULED = static_reply(HEAD_202_JSON, '{"playing": false, "scheduled": true}')
+STOP_OK = static_reply(HEAD_200_JSON, '{"status": "ok", "message": "All sounds stopped."}')
+HEALTH_OK = static_reply(
+    HEAD_200_JSON, json.dumps({"status": "ok", "device_id": DEVICE_ID, "api": API_VERSION})
+)
+
+
+async def handle_request(reader, writer):
+    """Serves HTTP requests on one connection until the client closes it."""
+    print("Client connected")
+    slot = acquire_slot()
     try:
-        request = str(request_line, "utf-8")
-        method, url, _ = request.split()
-        print(f"Request: {method} {url}")
-    except (ValueError, IndexError):
-        writer.write(b"HTTP/1.0 400 Bad Request\r\n\r\n")
-        await writer.drain()
+        if slot is None:
+            writer.write(SERVER_BUSY[False])
+            await writer.drain()
+            return
+        slot.task = asyncio.current_task()
+        while True:
+            result = await slot.read(reader)
+            slot.deadline = None
+            if result == REQ_CLOSED:
+                break
+            if result != REQ_OK:
+                writer.write((TOO_LARGE if result == REQ_TOO_LARGE else BAD_REQUEST)[False])
+                await writer.drain()
+                break
+
+            route = slot.route
+            print("Request:", ROUTE_LABELS[route])
+            if route == EVENTS_ROUTE:
+                # The SSE stream owns the connection until the client goes away,
+                # and never reads from it again
+                route_count[EVENTS_ROUTE] += 1
+                slot.release()
+                slot = None
+                await stream_events(writer)
+                break
+            started = time.ticks_us()
+            keep_alive = slot.keep_alive
+            writer.write(ROUTE_HANDLERS[route](slot.body(), slot.query(), keep_alive))
+            slot.next_request()
+            await writer.drain()
+            record_request(route, time.ticks_diff(time.ticks_us(), started))
+            if not keep_alive:
+                break
+    except OSError as e:
+        print(f"Connection error: {e}")
+    except asyncio.CancelledError:
+        # run_slot_sweeper() gave up on this client
+        print("Connection timed out")
+    finally:
+        if slot is not None:
+            slot.release()
         writer.close()
-        await writer.wait_closed()
-        return
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+        print("Client disconnected")
+
 
-    # Read current sensor value
-    light_value = photo_sensor_pin.read_u16()
+# --- API Endpoint Handlers ---
+# Each handler takes the raw request body, the query string and the
+# keep-alive flag and returns the complete encoded reply.
 
-    response = ""
-    content_type = "text/html"
-    status_line = "HTTP/1.0 503 Service Unavailable\r\n"
 
-    # --- API Endpoint Routing ---
-    if method == "GET" and url == "/":
-        html = f"""
+def handle_index(body, query, keep_alive):
+    light_value = latest_raw
+    html = f"""
         <html>
             <body>
                 <h1>Pico Light Orchestra</h1>
@@ -197,209 +1257,1234 @@ async def handle_request(reader, writer):
             </body>
         </html>
         """
-        response = html
-        status_line = "HTTP/1.0 200 OK\r\n"
-        
-    elif method == "GET" and url == "/sensor":
-        raw = photo_sensor_pin.read_u16()
-        clamped = clamp(raw, MIN_LIGHT, MAX_LIGHT)
-        norm = 0.0 if MAX_LIGHT == MIN_LIGHT else (clamped - MIN_LIGHT) / (MAX_LIGHT - MIN_LIGHT)
-        # Rough lux estimate
-        lux_est = norm * 200 
-        
+    return make_reply(HEAD_200_HTML, html.encode("utf-8"), keep_alive)
+
+
+def sensor_snapshot():
+    """Latest sensor sample as the /sensor fields."""
+    raw = latest_raw
+    norm = light_norm(raw)
+    # Rough lux estimate
+    lux_est = norm * 200
+    return {
+        "raw": raw,
+        "norm": round(norm, 2),
+        "lux_est": round(lux_est, 1)
+    }
+
+
+def handle_sensor(body, query, keep_alive):
+    response = json.dumps(sensor_snapshot())
+    return make_reply(HEAD_200_JSON, response.encode("utf-8"), keep_alive)
+
+
+def handle_health(body, query, keep_alive):
+    if wlan.isconnected():
+        return HEALTH_OK[keep_alive]
+
+    response = json.dumps({
+        "status": "error",
+        "device_id": DEVICE_ID,
+        "api": API_VERSION,
+        "errors": ["Wi-Fi disconnected"]
+    })
+    return make_reply(HEAD_503_JSON, response.encode("utf-8"), keep_alive)
+
+
+def handle_status(body, query, keep_alive):
+    """/health and /sensor in one body, so a dashboard refresh is one request."""
+    status = sensor_snapshot()
+    status["device_id"] = DEVICE_ID
+    status["api"] = API_VERSION
+    head = HEAD_200_JSON
+    if wlan.isconnected():
+        status["status"] = "ok"
+    else:
+        status["status"] = "error"
+        status["errors"] = ["Wi-Fi disconnected"]
+        head = HEAD_503_JSON
+    return make_reply(head, json.dumps(status).encode("utf-8"), keep_alive)
+
+
+def handle_play_note(body, query, keep_alive):
+    global api_note_task
+    try:
+        data = json.loads(body)
+        freq = float(data.get("frequency", 0))
+        duration = float(data.get("duration", 0))
+        at = data.get("at")
+        at = None if at is None else int(at)
+        seq = int(data.get("seq", 0))
+        if not (0 <= freq <= 65535 and 0 <= duration <= 65.535):
+            raise ValueError("Note out of range")
+    except (ValueError, TypeError, AttributeError, OverflowError):
+        return BAD_JSON[keep_alive]
+
+    if at is not None:
+        # Scheduled note: hold it in the jitter buffer instead of playing now
+        return schedule_note(
+            int(freq), int(duration * 1000), DUTY, at, seq, PLAY_NOTE_OK, keep_alive
+        )
+
+    extend_api_lock(duration * 1000 + 2000)
+
+    # If a note or melody is already playing via API, cancel it first
+    cancel_api_sound()
+
+    # Start the new note as a background task
+    api_note_task = asyncio.create_task(play_api_note(freq, duration, seq=seq))
+    return PLAY_NOTE_OK[keep_alive]
+
+
+def handle_tone(body, query, keep_alive):
+    global api_note_task
+    try:
+        data = json.loads(body)
+        # Extract parameters
+        freq = int(data.get("freq", 0))
+        ms = int(data.get("ms", 0))
+        duty = duty_to_u16(float(data.get("duty", 0.5)))
+        at = data.get("at")
+        at = None if at is None else int(at)
+        seq = int(data.get("seq", 0))
+        if not (0 <= freq <= 65535 and 0 <= ms <= 65535):
+            raise ValueError("Tone out of range")
+        attack, release = parse_ramps(data)
+    except (ValueError, TypeError, AttributeError, OverflowError):
+        return BAD_JSON[keep_alive]
+
+    if at is not None:
+        return schedule_note(
+            freq, ms, duty, at, seq, TONE_SCHEDULED, keep_alive,
+            attack, release
+        )
+
+    # If a note or melody is already playing via API, cancel it first
+    cancel_api_sound()
+
+    # Start new tone in background
+    api_note_task = asyncio.create_task(
+        play_api_note(freq, ms / 1000, duty, seq, attack, release)
+    )
+
+    # Prepare response (202 Accepted)
+    response = json.dumps({
+        "playing": True,
+        "until_ms_from_now": ms
+    })
+    return make_reply(HEAD_202_JSON, response.encode("utf-8"), keep_alive)
+
+
+def handle_melody(body, query, keep_alive):
+    try:
+        data = json.loads(body)
+        notes = data["notes"]
+        gap_ms = int(data.get("gap_ms", 0))
+        append = data.get("append", False)
+        at = data.get("at")
+        at = None if at is None else int(at)
+        parsed = []
+        for note in notes:
+            freq = int(note["freq"])
+            ms = int(note["ms"])
+            duty = note.get("duty")
+            duty = DUTY if duty is None else duty_to_u16(duty)
+            if not (0 <= freq <= 65535 and 0 <= ms <= 65535):
+                raise ValueError("Note out of range")
+            attack, release = parse_ramps(note)
+            parsed.append((freq, ms, duty, int(note.get("seq", 0)), attack, release))
+        if not 0 <= gap_ms <= 65535:
+            raise ValueError("Gap out of range")
+    except (ValueError, KeyError, TypeError):
+        return BAD_JSON[keep_alive]
+
+    # Unless this phrase extends the current one (or is scheduled behind it),
+    # it replaces whatever is playing
+    if not append and at is None:
+        cancel_api_sound()
+    if len(parsed) > NOTE_QUEUE_LEN - queue_depth:
+        return QUEUE_FULL[keep_alive]
+
+    last = len(parsed) - 1
+    for i, (freq, ms, duty, seq, attack, release) in enumerate(parsed):
+        # Gap between notes (skip after the last one); only the first note is
+        # timed, the rest follow it back to back
+        enqueue_note(freq, ms, gap_ms if i < last else 0, duty, at if i == 0 else None, seq,
+                     attack, release)
+
+    # Prepare response (202 Accepted)
+    response = json.dumps({
+        "queued": len(parsed),
+        "depth": queue_depth
+    })
+    return make_reply(HEAD_202_JSON, response.encode("utf-8"), keep_alive)
+
+
+def schedule_note(freq, ms, duty, at, seq, ok_reply, keep_alive,
+                  attack=ATTACK_MS, release=RELEASE_MS):
+    """Queues one note to start at device time `at` (ticks_ms)."""
+    if not (0 <= freq <= 65535 and 0 <= ms <= 65535):
+        return BAD_JSON[keep_alive]
+    if queue_depth >= NOTE_QUEUE_LEN:
+        return QUEUE_FULL[keep_alive]
+    enqueue_note(freq, ms, 0, duty, at, seq, attack, release)
+    return ok_reply[keep_alive]
+
+
+def parse_ramps(data):
+    """(attack_ms, release_ms) of a note or score object, defaulting to the constants."""
+    attack = int(data.get("attack_ms", ATTACK_MS))
+    release = int(data.get("release_ms", RELEASE_MS))
+    if not (0 <= attack <= ENGINE_RAMP_MAX_MS and 0 <= release <= ENGINE_RAMP_MAX_MS):
+        raise ValueError("Ramp out of range")
+    return attack, release
+
+
+def handle_score(body, query, keep_alive):
+    """Stores a whole score; plays it at once only if it carries "at".
+
+    Body: {"notes": [[pitch, duration, duty?], ...], "tempo": bpm, "steps": bool,
+    "gap_ms": ms, "attack_ms"/"release_ms": duty ramps of every note, "seq":
+    first play-log seq, "at": device ticks_ms}. Durations are beats when
+    "tempo" is given, otherwise milliseconds; pitch is Hz (or a scale step
+    with "steps": true) and 0 is a rest.
+    """
+    global score_len, score_gap_ms, score_seq_base, score_attack, score_release
+    try:
+        data = json.loads(body)
+        notes = data["notes"]
+        tempo = data.get("tempo")
+        beat_ms = 60000 / tempo if tempo else 1
+        steps = data.get("steps", False)
+        gap_ms = int(data.get("gap_ms", 0))
+        seq = int(data.get("seq", 0))
+        at = data.get("at")
+        at = None if at is None else int(at)
+        attack, release = parse_ramps(data)
+        if len(notes) > SCORE_MAX_NOTES:
+            raise ValueError("Score too long")
+        if not 0 <= gap_ms <= 65535:
+            raise ValueError("Gap out of range")
+        # Validate everything before touching the score that may be playing
+        resolved = []
+        for note in notes:
+            pitch = note[0]
+            ms = int(note[1] * beat_ms)
+            duty = DUTY if len(note) < 3 or note[2] is None else duty_to_u16(note[2])
+            if steps:
+                freq = step_to_freq(int(pitch))
+            else:
+                freq = step_to_freq(freq_to_nearest_step(pitch)) if pitch > 0 else 0
+            if not 0 <= ms <= 65535:
+                raise ValueError("Note too long")
+            resolved.append((freq, ms, duty))
+    except (ValueError, KeyError, TypeError, IndexError):
+        return BAD_JSON[keep_alive]
+
+    cancel_api_sound()
+    for k, (freq, ms, duty) in enumerate(resolved):
+        score_freq[k] = freq
+        score_ms[k] = ms
+        score_duty[k] = duty
+    score_len = len(resolved)
+    score_gap_ms = gap_ms
+    score_attack = attack
+    score_release = release
+    score_seq_base = seq
+    if at is not None:
+        start_score(at)
+
+    response = json.dumps({
+        "notes": score_len,
+        "duration_ms": score_duration_ms(),
+        "armed": at is not None
+    })
+    return make_reply(HEAD_202_JSON, response.encode("utf-8"), keep_alive)
+
+
+def handle_score_start(body, query, keep_alive):
+    """Plays the stored score now, or at {"at": device ticks_ms}."""
+    try:
+        at = json.loads(body).get("at") if body else None
+        at = None if at is None else int(at)
+    except (ValueError, TypeError, AttributeError):
+        return BAD_JSON[keep_alive]
+    if not score_len:
+        return NO_SCORE[keep_alive]
+    start = start_score(at)
+    response = b'{"started": true, "at": %d}' % start
+    return make_reply(HEAD_202_JSON, response, keep_alive)
+
+
+def handle_playlog(body, query, keep_alive):
+    """Note start log, oldest first: {"seq": [...], "ticks_ms": [...]}."""
+    engine_collect_log()
+    first = (playlog_head - playlog_count) % PLAYLOG_LEN
+    order = [(first + k) % PLAYLOG_LEN for k in range(playlog_count)]
+    response = json.dumps({
+        "seq": [playlog_seq[i] for i in order],
+        "ticks_ms": [playlog_ticks[i] for i in order]
+    })
+    return make_reply(HEAD_200_JSON, response.encode("utf-8"), keep_alive)
+
+
+def handle_time(body, query, keep_alive):
+    """Device clock for the conductor's offset/drift estimator."""
+    return make_reply(HEAD_200_JSON, b'{"ticks_ms": %d}' % time.ticks_ms(), keep_alive)
+
+
+def handle_queue(body, query, keep_alive):
+    response = json.dumps({
+        "depth": queue_depth,
+        "capacity": NOTE_QUEUE_LEN,
+        "position": melody_pos,
+        "total": melody_total,
+        "playing": sequencer_busy
+    })
+    return make_reply(HEAD_200_JSON, response.encode("utf-8"), keep_alive)
+
+
+def handle_stop(body, query, keep_alive):
+    cancel_api_sound()
+    stop_tone()  # Force immediate stop
+    return STOP_OK[keep_alive]
+
+
+def handle_tuning(body, query, keep_alive):
+    try:
+        data = json.loads(body)
+        set_tuning(
+            scale=data.get("scale"),
+            base_hz=data.get("base_hz"),
+            octaves=data.get("octaves"),
+            min_light=data.get("min_light"),
+            max_light=data.get("max_light"),
+        )
+    except (ValueError, TypeError, AttributeError, OverflowError):
+        return BAD_JSON[keep_alive]
+
+    response = json.dumps({
+        "scale": SCALE,
+        "steps": TOTAL_STEPS,
+        "freqs": list(step_freqs)
+    })
+    return make_reply(HEAD_200_JSON, response.encode("utf-8"), keep_alive)
+
+
+def filter_settings():
+    return {
+        "mode": FILTER_MODE,
+        "oversample": OVERSAMPLE,
+        "ema_shift": EMA_SHIFT,
+        "median_n": MEDIAN_N,
+        "hysteresis": HYSTERESIS,
+        "filtered": filtered_raw,
+        "step": light_step
+    }
+
+
+def handle_get_filter(body, query, keep_alive):
+    response = json.dumps(filter_settings())
+    return make_reply(HEAD_200_JSON, response.encode("utf-8"), keep_alive)
+
+
+def handle_filter(body, query, keep_alive):
+    try:
+        data = json.loads(body)
+        set_filter(
+            mode=data.get("mode"),
+            oversample=data.get("oversample"),
+            ema_shift=data.get("ema_shift"),
+            median_n=data.get("median_n"),
+            hysteresis=data.get("hysteresis"),
+        )
+    except (ValueError, TypeError, AttributeError):
+        return BAD_JSON[keep_alive]
+    return handle_get_filter(body, query, keep_alive)
+
+
+def calibration_status():
+    low = calibrate_low.value()
+    high = calibrate_high.value()
+    return {
+        "calibrating": calibrating,
+        "samples": calibrate_low.count,
+        "p10": None if low is None else int(low),
+        "p90": None if high is None else int(high),
+        "min_light": MIN_LIGHT,
+        "max_light": MAX_LIGHT
+    }
+
+
+def handle_get_calibrate(body, query, keep_alive):
+    response = json.dumps(calibration_status())
+    return make_reply(HEAD_200_JSON, response.encode("utf-8"), keep_alive)
+
+
+def handle_calibrate(body, query, keep_alive):
+    """{"action": "start", "ms": <optional auto-stop>} or {"action": "stop", "apply": true}."""
+    try:
+        data = json.loads(body)
+        action = data["action"]
+        if action == "start":
+            ms = data.get("ms")
+            start_calibration(None if ms is None else int(ms))
+            status = calibration_status()
+        elif action == "stop":
+            applied = finish_calibration(bool(data.get("apply", True)))[2]
+            status = calibration_status()
+            status["applied"] = applied
+        else:
+            raise ValueError("Unknown action")
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return BAD_JSON[keep_alive]
+    return make_reply(HEAD_200_JSON, json.dumps(status).encode("utf-8"), keep_alive)
+
+
+def handle_sensor_history(body, query, keep_alive):
+    """History after ?since=<ticks_ms>, as packed binary or ?format=json.
+
+    Binary layout (little-endian): u16 count, u16 interval_ms, then count u32
+    tick stamps followed by count u16 raw readings.
+    """
+    try:
+        params = parse_query(query)
+        if "since" in params:
+            first, count = history_window(int(params["since"]))
+        else:
+            first, count = (history_head - history_count) % HISTORY_LEN, history_count
+    except ValueError:
+        return BAD_REQUEST[keep_alive]
+    # Split the window where the ring buffer wraps
+    end = first + count
+    tail = end - HISTORY_LEN if end > HISTORY_LEN else 0
+    end -= tail
+
+    if params.get("format") == "json":
+        ticks = list(history_ticks[first:end]) + list(history_ticks[:tail])
+        raws = list(history_raw[first:end]) + list(history_raw[:tail])
         response = json.dumps({
-            "raw": raw,
-            "norm": round(norm, 2),
-            "lux_est": round(lux_est, 1)
+            "interval_ms": SAMPLE_INTERVAL_MS * HISTORY_DECIMATE,
+            "ts": ticks,
+            "raw": raws
         })
-        status_line = "HTTP/1.0 200 OK\r\n"
-        content_type = "application/json"
-
-    elif method == "GET" and url == "/health":
-        device_ok = True
-        errors = []
-
-        # Wi-Fi check (inline, no function)
-        if not wlan.isconnected():
-            device_ok = False
-            errors.append("Wi-Fi disconnected")
-
-    # Build the response
-        response = {
-        "status": "ok" if device_ok else "error",
-        "device_id": get_device_id(),
-        "api": "1.0.0"
-        }
-        if errors:
-            response["errors"] = errors
-
-    # HTTP status
-        status_line = (
-            "HTTP/1.0 200 OK\r\n"
-            if device_ok
-            else "HTTP/1.0 503 Service Unavailable\r\n"
-        )
-        content_type = "application/json"
-        
-    elif method == "POST" and url == "/play_note":
-        # This requires reading the request body, which is not trivial.
-        # A simple approach for a known content length:
-        # Note: A robust server would parse Content-Length header.
-        # For this student project, we'll assume a small, simple JSON body.
-        raw_data = await reader.read(1024)
-        try:
-            data = json.loads(raw_data)
-            freq = data.get("frequency", 0)
-            duration = data.get("duration", 0)
+        return make_reply(HEAD_200_JSON, response.encode("utf-8"), keep_alive)
 
-            extend_api_lock(duration * 1000 + 2000)
+    ticks_view = memoryview(history_ticks)
+    raw_view = memoryview(history_raw)
+    packed = bytearray(struct.pack("<HH", count, SAMPLE_INTERVAL_MS * HISTORY_DECIMATE))
+    packed += ticks_view[first:end]
+    packed += ticks_view[:tail]
+    packed += raw_view[first:end]
+    packed += raw_view[:tail]
+    return make_reply(HEAD_200_BINARY, bytes(packed), keep_alive)
 
-            # If a note is already playing via API, cancel it first
-            if api_note_task:
-                api_note_task.cancel()
 
-            # Start the new note as a background task
-            api_note_task = asyncio.create_task(play_api_note(freq, duration))
+def handle_metrics(body, query, keep_alive):
+    """Prometheus text exposition of the counters in the Metrics section."""
+    lines = []
+    add = lines.append
+    add("# TYPE pico_http_requests_total counter")
+    for i, label in enumerate(ROUTE_LABELS):
+        add('pico_http_requests_total{route="%s"} %d' % (label, route_count[i]))
 
-            response = '{"status": "ok", "message": "Note playing started."}'
-            content_type = "application/json"
-        except (ValueError, json.JSONDecodeError):
-            writer.write(b'HTTP/1.0 400 Bad Request\r\n\r\n{"error": "Invalid JSON"}\r\n')
-            await writer.drain()
-            writer.close()
-            await writer.wait_closed()
-            return
+    # Only routes that served something, to keep the scrape small
+    add("# TYPE pico_http_request_duration_seconds histogram")
+    buckets = len(LATENCY_BUCKETS_US) + 1
+    for i, label in enumerate(ROUTE_LABELS):
+        if i == EVENTS_ROUTE or not route_count[i]:
+            continue
+        total = 0
+        for b in range(buckets):
+            total += route_hist[i * buckets + b]
+            add('pico_http_request_duration_seconds_bucket{route="%s",le="%s"} %d'
+                % (label, LATENCY_LE[b], total))
+        add('pico_http_request_duration_seconds_sum{route="%s"} %.6f'
+            % (label, route_us_sum[i] / 1000000))
+        add('pico_http_request_duration_seconds_count{route="%s"} %d' % (label, route_count[i]))
+
+    add("# TYPE pico_light_loop_lag_seconds histogram")
+    total = 0
+    for b in range(len(LAG_BUCKETS_MS) + 1):
+        total += loop_hist[b]
+        add('pico_light_loop_lag_seconds_bucket{le="%s"} %d' % (LAG_LE[b], total))
+    add("pico_light_loop_lag_seconds_sum %.3f" % (counters[C_LOOP_LAG_SUM_MS] / 1000))
+    add("pico_light_loop_lag_seconds_count %d" % total)
+    add("# TYPE pico_light_loop_lag_max_seconds gauge")
+    add("pico_light_loop_lag_max_seconds %.3f" % (counters[C_LOOP_LAG_MAX_MS] / 1000))
+
+    add("# TYPE pico_timed_note_starts_total counter")
+    add("pico_timed_note_starts_total %d" % counters[C_TIMED_STARTS])
+    add("# TYPE pico_late_note_starts_total counter")
+    add("pico_late_note_starts_total %d" % counters[C_LATE_STARTS])
+    add("# TYPE pico_note_start_lateness_max_seconds gauge")
+    add("pico_note_start_lateness_max_seconds %.3f" % (counters[C_LATE_MAX_MS] / 1000))
+    add("# TYPE pico_udp_datagrams_total counter")
+    add("pico_udp_datagrams_total %d" % counters[C_UDP_DATAGRAMS])
 
-    elif method == "POST" and url == "/tone":
-        raw_data = await reader.read(1024)
+    add("# TYPE pico_gc_collections_total counter")
+    for r, reason in enumerate(GC_REASONS):
+        add('pico_gc_collections_total{reason="%s"} %d' % (reason, gc_count[r]))
+    add("# TYPE pico_gc_pause_seconds histogram")
+    total = 0
+    for b in range(len(GC_PAUSE_BUCKETS_US) + 1):
+        total += gc_hist[b]
+        add('pico_gc_pause_seconds_bucket{le="%s"} %d' % (GC_PAUSE_LE[b], total))
+    add("pico_gc_pause_seconds_sum %.6f" % (counters[C_GC_PAUSE_SUM_US] / 1000000))
+    add("pico_gc_pause_seconds_count %d" % total)
+    add("# TYPE pico_gc_pause_max_seconds gauge")
+    add("pico_gc_pause_max_seconds %.6f" % (counters[C_GC_PAUSE_MAX_US] / 1000000))
+    add("# TYPE pico_gc_during_note_total counter")
+    add("pico_gc_during_note_total %d" % counters[C_GC_DURING_NOTE])
+    add("# TYPE pico_gc_auto_enabled gauge")
+    add("pico_gc_auto_enabled %d" % (gc_holds == 0))
+    add("# TYPE pico_dual_core gauge")
+    add("pico_dual_core %d" % core1_running)
+    add("# TYPE pico_core1_samples_dropped_total counter")
+    add("pico_core1_samples_dropped_total %d" % samples_dropped)
+    add("# TYPE pico_gc_mem_free_bytes gauge")
+    add("pico_gc_mem_free_bytes %d" % gc.mem_free())
+    add("# TYPE pico_gc_mem_alloc_bytes gauge")
+    add("pico_gc_mem_alloc_bytes %d" % gc.mem_alloc())
+    add("# TYPE pico_wifi_connected gauge")
+    add("pico_wifi_connected %d" % wlan.isconnected())
+    if wlan.isconnected():
         try:
-            data = json.loads(raw_data)
-            # Extract parameters
-            freq = data.get("freq", 0)
-            ms = data.get("ms", 0)
-            duty = data.get("duty", 0.5)
-
-            # If a note is already playing via API, cancel it first
-            if api_note_task:
-                api_note_task.cancel()
-
-            # Start new tone in background
-            api_note_task = asyncio.create_task(play_api_note(freq, ms, duty))
-
-            # Prepare response (202 Accepted)
-            response = json.dumps({
-                "playing": True,
-                "until_ms_from_now": ms
-            })
-            status_line = "HTTP/1.0 202 Accepted\r\n"
-            content_type = "application/json"
-
-        except (ValueError, json.JSONDecodeError):
-            writer.write(b'HTTP/1.0 400 Bad Request\r\n\r\n{"error": "Invalid JSON"}\r\n')
-            await writer.drain()
-            writer.close()
-            await writer.wait_closed()
-            return
-    elif method == "POST" and url == "/melody":
-        raw_data = await reader.read(1024)
+            add("# TYPE pico_wifi_rssi_dbm gauge")
+            add("pico_wifi_rssi_dbm %d" % wlan.status("rssi"))
+        except (OSError, ValueError):
+            lines.pop()
+    add("# TYPE pico_wifi_reconnects_total counter")
+    add("pico_wifi_reconnects_total %d" % wifi_reconnects)
+    add("")
+    return make_reply(HEAD_200_METRICS, "\n".join(lines).encode("utf-8"), keep_alive)
+
+
+def handle_not_found(body, query, keep_alive):
+    return NOT_FOUND[keep_alive]
+
+
+# Dispatch table: (method, path) -> handler
+ROUTES = {
+    ("GET", "/"): handle_index,
+    ("GET", "/sensor"): handle_sensor,
+    ("GET", "/sensor/history"): handle_sensor_history,
+    ("GET", "/health"): handle_health,
+    ("GET", "/status"): handle_status,
+    ("POST", "/play_note"): handle_play_note,
+    ("POST", "/tone"): handle_tone,
+    ("POST", "/melody"): handle_melody,
+    ("GET", "/queue"): handle_queue,
+    ("GET", "/time"): handle_time,
+    ("GET", "/playlog"): handle_playlog,
+    ("POST", "/score"): handle_score,
+    ("POST", "/score/start"): handle_score_start,
+    ("POST", "/stop"): handle_stop,
+    ("POST", "/tuning"): handle_tuning,
+    ("GET", "/filter"): handle_get_filter,
+    ("POST", "/filter"): handle_filter,
+    ("GET", "/calibrate"): handle_get_calibrate,
+    ("POST", "/calibrate"): handle_calibrate,
+    ("GET", "/metrics"): handle_metrics,
+}
+
+
+# --- Metrics ---
+# Counters behind GET /metrics. Everything is allocated here at boot and
+# indexed by route number, so recording a request or a loop tick is a few
+# integer stores; text is only built when /metrics is scraped.
+LATENCY_BUCKETS_US = (500, 1000, 2500, 5000, 10000, 25000, 100000)
+LAG_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100)
+LATE_START_MS = 2          # a timed note starting later than this counts as late
+GC_PAUSE_BUCKETS_US = (1000, 2000, 5000, 10000, 20000, 50000)
+LATENCY_LE = ["%g" % (us / 1000000) for us in LATENCY_BUCKETS_US] + ["+Inf"]
+LAG_LE = ["%g" % (ms / 1000) for ms in LAG_BUCKETS_MS] + ["+Inf"]
+GC_PAUSE_LE = ["%g" % (us / 1000000) for us in GC_PAUSE_BUCKETS_US] + ["+Inf"]
+
+# Route numbers: one per ROUTES entry, then /events, then everything else
+ROUTE_INDEX = {key: i for i, key in enumerate(ROUTES)}
+ROUTE_HANDLERS = list(ROUTES.values()) + [handle_not_found, handle_not_found]
+ROUTE_LABELS = ["%s %s" % key for key in ROUTES] + ["GET /events", "other"]
+EVENTS_ROUTE = len(ROUTES)
+OTHER_ROUTE = EVENTS_ROUTE + 1
+SCORE_ROUTE = ROUTE_INDEX[("POST", "/score")]
+# The same keys as bytes, matched in place against the request buffer
+ROUTE_KEYS = [(m.encode("utf-8"), p.encode("utf-8")) for m, p in ROUTES] + [(b"GET", b"/events")]
+
+route_count = array("I", [0] * len(ROUTE_LABELS))
+route_us_sum = array("I", [0] * len(ROUTE_LABELS))   # wraps after ~71 min of handler time
+route_hist = array("I", [0] * (len(ROUTE_LABELS) * (len(LATENCY_BUCKETS_US) + 1)))
+loop_hist = array("I", [0] * (len(LAG_BUCKETS_MS) + 1))
+gc_hist = array("I", [0] * (len(GC_PAUSE_BUCKETS_US) + 1))
+
+# Scalar counters, by index
+C_LOOP_LAG_SUM_MS = 0
+C_LOOP_LAG_MAX_MS = 1
+C_TIMED_STARTS = 2
+C_LATE_STARTS = 3
+C_LATE_MAX_MS = 4
+C_UDP_DATAGRAMS = 5
+C_GC_PAUSE_SUM_US = 6
+C_GC_PAUSE_MAX_US = 7
+C_GC_DURING_NOTE = 8
+counters = array("I", [0] * 9)
+
+
+def bucket_index(bounds, value):
+    """Index of the first histogram bucket whose upper bound holds value."""
+    for b in range(len(bounds)):
+        if value <= bounds[b]:
+            return b
+    return len(bounds)
+
+
+def record_request(route, us):
+    route_count[route] += 1
+    route_us_sum[route] = (route_us_sum[route] + us) & 0xFFFFFFFF
+    route_hist[route * (len(LATENCY_BUCKETS_US) + 1) + bucket_index(LATENCY_BUCKETS_US, us)] += 1
+
+
+def record_loop_lag(lag_ms):
+    """How much later than LIGHT_LOOP_MS this light-loop tick came."""
+    if lag_ms < 0:
+        lag_ms = 0
+    loop_hist[bucket_index(LAG_BUCKETS_MS, lag_ms)] += 1
+    counters[C_LOOP_LAG_SUM_MS] = (counters[C_LOOP_LAG_SUM_MS] + lag_ms) & 0xFFFFFFFF
+    if lag_ms > counters[C_LOOP_LAG_MAX_MS]:
+        counters[C_LOOP_LAG_MAX_MS] = lag_ms
+
+
+def record_note_start(late_ms):
+    """A timed note (or score note) reached the PWM `late_ms` after its start tick."""
+    counters[C_TIMED_STARTS] += 1
+    if late_ms > LATE_START_MS:
+        counters[C_LATE_STARTS] += 1
+        if late_ms > counters[C_LATE_MAX_MS]:
+            counters[C_LATE_MAX_MS] = late_ms
+
+
+# --- Garbage Collection ---
+# On the Pico an automatic collection runs whenever an allocation finds the
+# heap full, which can be in the middle of a note. While anything plays,
+# automatic collection is therefore off and the players collect in their own
+# silences instead: rests, gaps, the wait before a timed note and the end of
+# a song. The light loop forces a collection if free heap still runs low.
+GC_IDLE = 0                # reasons, indexing gc_count
+GC_PRESSURE = 1
+GC_REASONS = ("idle", "pressure")
+gc_count = array("I", [0] * len(GC_REASONS))
+gc_holds = 0               # players currently holding automatic collection off
+gc_last_us = 0             # duration of the most recent collection
+gc_alloc_after = 0         # gc.mem_alloc() right after the most recent collection
+
+
+def collect(reason):
+    """Runs gc.collect() and records its pause; returns the pause in ms."""
+    global gc_last_us, gc_alloc_after
+    started = time.ticks_us()
+    gc.collect()
+    us = time.ticks_diff(time.ticks_us(), started)
+    gc_last_us = us
+    gc_alloc_after = gc.mem_alloc()
+    gc_count[reason] += 1
+    gc_hist[bucket_index(GC_PAUSE_BUCKETS_US, us)] += 1
+    counters[C_GC_PAUSE_SUM_US] = (counters[C_GC_PAUSE_SUM_US] + us) & 0xFFFFFFFF
+    if us > counters[C_GC_PAUSE_MAX_US]:
+        counters[C_GC_PAUSE_MAX_US] = us
+    if gc_holds and buzzer_pin.duty_u16():
+        counters[C_GC_DURING_NOTE] += 1
+    return us // 1000
+
+
+def idle_collect(window_ms):
+    """Collects if a silence of window_ms can absorb it; returns the ms spent."""
+    if window_ms < GC_IDLE_MIN_MS or window_ms * 1000 < 2 * gc_last_us:
+        return 0
+    if gc.mem_alloc() - gc_alloc_after < GC_IDLE_MIN_GARBAGE:
+        return 0
+    return collect(GC_IDLE)
+
+
+def gc_hold():
+    """A player starts: automatic collection stays off until gc_release()."""
+    global gc_holds
+    if gc_holds == 0:
+        if gc.mem_free() < 2 * GC_PRESSURE_BYTES:
+            collect(GC_IDLE)  # nothing sounds yet, so start with headroom
+        gc.disable()
+    gc_holds += 1
+
+
+def gc_release():
+    """A player finished; the last one out re-enables automatic collection."""
+    global gc_holds
+    gc_holds -= 1
+    if gc_holds == 0:
+        gc.enable()
+        idle_collect(GC_IDLE_MIN_MS)  # between songs
+
+
+def check_memory():
+    """Forces a collection when free heap falls under GC_PRESSURE_BYTES."""
+    if gc_holds and gc.mem_free() < GC_PRESSURE_BYTES:
+        collect(GC_PRESSURE)
+
+
+# --- UDP Command Channel ---
+# Fixed-size little-endian datagrams for latency-critical commands. Every
+# packet starts with HEADER: magic b"PL", type, flags, seq (u32). Senders
+# number packets; a seq that is not newer than the last one seen from that
+# address is a duplicate and only re-acked. DISCOVER is the exception: hosts
+# broadcast it to find devices, and it is always answered.
+UDP_HEADER = "<2sBBI"
+UDP_TONE = UDP_HEADER + "HHH"             # freq Hz, ms, duty_u16 (0 = default DUTY)
+UDP_MELODY = UDP_HEADER + "BBH" + "HH" * 4  # count, reserved, gap_ms, 4 (freq, ms) notes
+UDP_TONE_AT = UDP_TONE + "I"              # tone + device ticks_ms start time
+UDP_ACK = UDP_HEADER + "B"                # status
+UDP_MAGIC = b"PL"
+UDP_TYPE_TONE = 1
+UDP_TYPE_STOP = 2
+UDP_TYPE_MELODY = 3
+UDP_TYPE_TONE_AT = 4
+UDP_TYPE_DISCOVER = 5                     # answered with header + JSON device info
+UDP_TYPE_ACK = 0x80                       # OR-ed with the acknowledged type
+UDP_FLAG_ACK = 0x01                       # sender wants an ack datagram
+UDP_FLAG_APPEND = 0x02                    # melody chunk extends the queue
+UDP_OK = 0
+UDP_QUEUE_FULL = 1
+UDP_BAD_PACKET = 2
+UDP_TONE_SIZE = struct.calcsize(UDP_TONE)
+UDP_MELODY_SIZE = struct.calcsize(UDP_MELODY)
+UDP_TONE_AT_SIZE = struct.calcsize(UDP_TONE_AT)
+UDP_HEADER_SIZE = struct.calcsize(UDP_HEADER)
+
+udp_last_seq: dict = {}  # sender ip -> newest seq executed
+
+
+def run_udp_command(kind, flags, seq, packet):
+    """Executes one datagram command and returns its ack status."""
+    global api_note_task
+    if kind == UDP_TYPE_TONE and len(packet) == UDP_TONE_SIZE:
+        _, _, _, _, freq, ms, duty = struct.unpack(UDP_TONE, packet)
+        cancel_api_sound()
+        api_note_task = asyncio.create_task(play_api_note(freq, ms / 1000, duty or None, seq))
+        return UDP_OK
+
+    if kind == UDP_TYPE_TONE_AT and len(packet) == UDP_TONE_AT_SIZE:
+        _, _, _, _, freq, ms, duty, at = struct.unpack(UDP_TONE_AT, packet)
+        if queue_depth >= NOTE_QUEUE_LEN:
+            return UDP_QUEUE_FULL
+        enqueue_note(freq, ms, 0, duty or DUTY, at, seq)
+        return UDP_OK
+
+    if kind == UDP_TYPE_STOP:
+        cancel_api_sound()
+        stop_tone()
+        return UDP_OK
+
+    if kind == UDP_TYPE_MELODY and len(packet) == UDP_MELODY_SIZE:
+        fields = struct.unpack(UDP_MELODY, packet)
+        count = fields[4]
+        gap_ms = fields[6]
+        if count > 4:
+            return UDP_BAD_PACKET
+        if not flags & UDP_FLAG_APPEND:
+            cancel_api_sound()
+        if count > NOTE_QUEUE_LEN - queue_depth:
+            return UDP_QUEUE_FULL
+        for i in range(count):
+            enqueue_note(fields[7 + 2 * i], fields[8 + 2 * i], gap_ms, DUTY)
+        return UDP_OK
+
+    return UDP_BAD_PACKET
+
+
+def discovery_reply(seq):
+    """Answer to a DISCOVER beacon: header plus this device's JSON description."""
+    info = json.dumps({
+        "device_id": DEVICE_ID,
+        "ip": wlan.ifconfig()[0],
+        "http_port": HTTP_PORT,
+        "api": API_VERSION,
+        "caps": CAPABILITIES
+    })
+    header = struct.pack(UDP_HEADER, UDP_MAGIC, UDP_TYPE_ACK | UDP_TYPE_DISCOVER, 0, seq)
+    return header + info.encode("utf-8")
+
+
+def handle_datagram(packet, addr):
+    """Parses one datagram; returns the ack to send back, or None."""
+    if len(packet) < UDP_HEADER_SIZE:
+        return None
+    magic, kind, flags, seq = struct.unpack_from(UDP_HEADER, packet)
+    if magic != UDP_MAGIC:
+        return None
+    if kind == UDP_TYPE_DISCOVER:
+        return discovery_reply(seq)
+
+    sender = addr[0]
+    last = udp_last_seq.get(sender)
+    # Serial-number comparison so the 32-bit sequence may wrap
+    diff = 1 if last is None else (seq - last) & 0xFFFFFFFF
+    if diff == 0 or diff >= 0x80000000:
+        status = UDP_OK  # duplicate or stale: don't replay, just re-ack
+    else:
+        udp_last_seq[sender] = seq
+        status = run_udp_command(kind, flags, seq, packet)
+
+    if flags & UDP_FLAG_ACK:
+        return struct.pack(UDP_ACK, UDP_MAGIC, UDP_TYPE_ACK | kind, 0, seq, status)
+    return None
+
+
+async def run_udp_server(port):
+    """Receives binary note commands on a non-blocking UDP socket."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((BIND_HOST, port))
+    sock.setblocking(False)
+    print(f"UDP command channel on port {port}")
+    while True:
         try:
-            data = json.loads(raw_data)
-            notes = data["notes"]
-            # Extract parameters
-            duty = 0.5
-            gap_ms = data["gap_ms"] / 1000
-            num_notes = len(data["notes"])
-
-            # If a note is already playing via API, cancel it first
-            if api_note_task:
-                api_note_task.cancel()
-
-            # play sequence of notes
-            for i, note in enumerate(notes):
-                freq = note["freq"]
-                ms = note["ms"]
-
-                # Play the note
-                api_note_task = asyncio.create_task(play_api_note(freq, ms, duty))
-                await api_note_task  # wait for the note to finish
-
-                # Gap between notes (skip after the last one)
-                if i < num_notes - 1 and gap_ms > 0:
-                    await asyncio.sleep(gap_ms)
-
-        # Prepare response (202 Accepted)
-            response = json.dumps({
-                "queued": num_notes,
-            })
-            status_line = "HTTP/1.0 202 Accepted\r\n"
-            content_type = "application/json"
-
-        except (ValueError, json.JSONDecodeError):
-            writer.write(b'HTTP/1.0 400 Bad Request\r\n\r\n{"error": "Invalid JSON"}\r\n')
-            await writer.drain()
-            writer.close()
-            await writer.wait_closed()
+            packet, addr = sock.recvfrom(UDP_MELODY_SIZE)
+        except OSError:
+            await asyncio.sleep_ms(UDP_POLL_MS)  # type: ignore[attr-defined]
+            continue
+        counters[C_UDP_DATAGRAMS] += 1
+        ack = handle_datagram(packet, addr)
+        if ack is not None:
+            try:
+                sock.sendto(ack, addr)
+            except OSError as e:
+                print(f"UDP ack failed: {e}")
+
+
+# --- Signal Conditioning ---
+# Every sample is the mean of OVERSAMPLE ADC reads, smoothed by an integer EMA
+# or a running median, then quantized to a step that only moves once the
+# reading is HYSTERESIS of a step past the boundary. Each stage is O(1) per
+# sample and works on preallocated state, so the light loop just reads
+# light_step and touches the PWM only when it changes.
+ema_acc = -1                            # EMA state scaled by 2**EMA_SHIFT; -1 = unset
+median_ring = array("H", [0] * MEDIAN_MAX)
+median_sorted = array("H", [0] * MEDIAN_MAX)
+median_head = 0
+median_count = 0
+filtered_raw = 0    # conditioned reading the light loop follows
+light_step = 0      # quantized step with hysteresis applied
+
+
+def reset_filter():
+    """Drops the filter history, e.g. after its parameters change."""
+    global ema_acc, median_head, median_count
+    ema_acc = -1
+    median_head = 0
+    median_count = 0
+
+
+def read_oversampled():
+    """Mean of OVERSAMPLE back-to-back ADC reads."""
+    total = 0
+    for _ in range(OVERSAMPLE):
+        total += photo_sensor_pin.read_u16()
+    return total // OVERSAMPLE
+
+
+def filter_sample(raw):
+    """Feeds one reading through the active filter; returns the smoothed value."""
+    global ema_acc, median_head, median_count
+    if FILTER_MODE == "ema":
+        if ema_acc < 0:
+            ema_acc = raw << EMA_SHIFT
+        else:
+            ema_acc += raw - (ema_acc >> EMA_SHIFT)
+        return ema_acc >> EMA_SHIFT
+    if FILTER_MODE == "median":
+        median_ring[median_head] = raw
+        median_head = (median_head + 1) % MEDIAN_N
+        if median_count < MEDIAN_N:
+            median_count += 1
+        # Insertion sort of at most MEDIAN_MAX values into the scratch array
+        n = median_count
+        for i in range(n):
+            v = median_ring[i]
+            j = i
+            while j > 0 and median_sorted[j - 1] > v:
+                median_sorted[j] = median_sorted[j - 1]
+                j -= 1
+            median_sorted[j] = v
+        return median_sorted[n >> 1]
+    return raw
+
+
+def quantize_with_hysteresis(raw):
+    """Filtered reading -> step, holding the current step inside its dead band."""
+    global light_step
+    step = light_to_nearest_step(raw)
+    if step != light_step:
+        # Distance from the held step's centre, in steps
+        if abs(light_norm(raw) * TOTAL_STEPS - light_step) >= 0.5 + HYSTERESIS:
+            light_step = step
+    return light_step
+
+
+def condition_sample(raw):
+    """Runs one oversampled reading through the filter and quantizer."""
+    global filtered_raw
+    filtered_raw = filter_sample(raw)
+    quantize_with_hysteresis(filtered_raw)
+
+
+def set_filter(mode=None, oversample=None, ema_shift=None, median_n=None, hysteresis=None):
+    """Changes any conditioning parameter (validated first) and resets the filter."""
+    global FILTER_MODE, OVERSAMPLE, EMA_SHIFT, MEDIAN_N, HYSTERESIS
+    if mode is not None and mode not in FILTER_MODES:
+        raise ValueError("Unknown filter mode")
+    if oversample is not None and not 1 <= int(oversample) <= 16:
+        raise ValueError("oversample must be 1..16")
+    if ema_shift is not None and not 0 <= int(ema_shift) <= 8:
+        raise ValueError("ema_shift must be 0..8")
+    if median_n is not None and (not 1 <= int(median_n) <= MEDIAN_MAX or not int(median_n) & 1):
+        raise ValueError("median_n must be odd and at most MEDIAN_MAX")
+    if hysteresis is not None and not 0 <= float(hysteresis) <= 1:
+        raise ValueError("hysteresis must be 0..1")
+    if mode is not None:
+        FILTER_MODE = mode
+    if oversample is not None:
+        OVERSAMPLE = int(oversample)
+    if ema_shift is not None:
+        EMA_SHIFT = int(ema_shift)
+    if median_n is not None:
+        MEDIAN_N = int(median_n)
+    if hysteresis is not None:
+        HYSTERESIS = float(hysteresis)
+    reset_filter()
+
+
+# --- Auto-Calibration ---
+# While calibrating, every sampler reading feeds two P² estimators (Jain &
+# Chlamtac), which track one quantile each in five markers without storing
+# the samples. Stopping applies P10/P90 as MIN_LIGHT/MAX_LIGHT and rebuilds
+# the light table in one synchronous call, so no task sees a half-applied range.
+
+
+class P2Quantile:
+    """Streaming estimate of quantile p in constant memory (P² algorithm)."""
+
+    def __init__(self, p):
+        self.p = p
+        self.q = array("f", [0.0] * 5)     # marker heights
+        self.n = array("i", [0] * 5)       # marker positions
+        self.want = array("f", [0.0] * 5)  # desired marker positions
+        self.inc = array("f", [0.0, p / 2, p, (1 + p) / 2, 1.0])
+        self.count = 0
+
+    def reset(self):
+        self.count = 0
+
+    def add(self, x):
+        q = self.q
+        n = self.n
+        if self.count < 5:
+            # Collect the first five observations in sorted order
+            i = self.count
+            while i > 0 and q[i - 1] > x:
+                q[i] = q[i - 1]
+                i -= 1
+            q[i] = x
+            self.count += 1
+            if self.count == 5:
+                p = self.p
+                for i in range(5):
+                    n[i] = i
+                self.want[0] = 0.0
+                self.want[1] = 2 * p
+                self.want[2] = 4 * p
+                self.want[3] = 2 + 2 * p
+                self.want[4] = 4.0
             return
-            
-    elif method == "POST" and url == "/stop":
-        if api_note_task:
-            api_note_task.cancel()
-            api_note_task = None
-        stop_tone()  # Force immediate stop
-        response = '{"status": "ok", "message": "All sounds stopped."}'
-        content_type = "application/json"
-        
-    else:
-        writer.write(b"HTTP/1.0 404 Not Found\r\n\r\n")
+        self.count += 1
+
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k += 1
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.want[i] += self.inc[i]
+
+        # Nudge the three middle markers towards their desired positions
+        for i in range(1, 4):
+            d = self.want[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                height = q[i] + d / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+                    + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+                )
+                if not q[i - 1] < height < q[i + 1]:
+                    # Parabolic guess left the bracket; fall back to linear
+                    height = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = height
+                n[i] += d
+
+    def value(self):
+        if self.count >= 5:
+            return self.q[2]
+        if not self.count:
+            return None
+        # Too few samples for the markers: nearest rank of what we have
+        return self.q[min(self.count - 1, int(self.p * self.count))]
+
+
+calibrate_low = P2Quantile(CALIBRATE_LOW)
+calibrate_high = P2Quantile(CALIBRATE_HIGH)
+calibrating = False
+calibrate_until = None   # ticks_ms at which calibration stops by itself, or None
+
+
+def start_calibration(ms=None):
+    """Starts collecting readings; with `ms`, stops and applies after that long."""
+    global calibrating, calibrate_until
+    calibrate_low.reset()
+    calibrate_high.reset()
+    calibrate_until = None if ms is None else time.ticks_add(time.ticks_ms(), int(ms))
+    calibrating = True
+
+
+def finish_calibration(apply=True):
+    """Stops collecting; returns (low, high, applied) for the readings seen."""
+    global calibrating, calibrate_until
+    calibrating = False
+    calibrate_until = None
+    low = calibrate_low.value()
+    high = calibrate_high.value()
+    if low is None or high is None:
+        return None, None, False
+    low = int(low)
+    high = int(high)
+    applied = (
+        apply
+        and calibrate_low.count >= CALIBRATE_MIN_SAMPLES
+        and high - low >= CALIBRATE_MIN_SPAN
+    )
+    if applied:
+        set_tuning(min_light=low, max_light=high)
+        print(f"Calibrated light range: {low}..{high}")
+    return low, high, applied
+
+
+def calibrate_sample(raw):
+    """Feeds one sampler reading to the estimators (called while calibrating)."""
+    calibrate_low.add(raw)
+    calibrate_high.add(raw)
+    if calibrate_until is not None and time.ticks_diff(time.ticks_ms(), calibrate_until) >= 0:
+        finish_calibration()
+
+
+# --- Sensor Sampler & History ---
+# run_sensor_sampler() is the only reader of the ADC. Everything else uses the
+# cached latest_raw; every HISTORY_DECIMATE samples the mean is appended to a
+# preallocated ring buffer that GET /sensor/history serves.
+latest_raw = photo_sensor_pin.read_u16()
+latest_ticks = time.ticks_ms()  # type: ignore[attr-defined]
+history_ticks = array("I", [0] * HISTORY_LEN)
+history_raw = array("H", [0] * HISTORY_LEN)
+history_head = 0    # slot the next entry goes into
+history_count = 0   # valid entries, up to HISTORY_LEN
+
+
+async def run_sensor_sampler():
+    """Samples the photosensor at a fixed rate and records its history.
+
+    In dual-core mode core 1 takes the readings and this drains the sample ring.
+    """
+    global latest_raw, latest_ticks, history_head, history_count
+    batch_raw = array("H", [0] * SAMPLE_RING_LEN)
+    batch_ticks = array("I", [0] * SAMPLE_RING_LEN)
+    total = 0
+    n = 0
+    while True:
+        if core1_running:
+            count = take_samples(batch_raw, batch_ticks)
+        else:
+            batch_raw[0] = read_oversampled()
+            batch_ticks[0] = time.ticks_ms()
+            count = 1
+        for k in range(count):
+            latest_raw = batch_raw[k]
+            latest_ticks = batch_ticks[k]
+            condition_sample(latest_raw)
+            if calibrating:
+                calibrate_sample(latest_raw)
+            total += latest_raw
+            n += 1
+            if n == HISTORY_DECIMATE:
+                history_ticks[history_head] = latest_ticks
+                history_raw[history_head] = total // n
+                history_head = (history_head + 1) % HISTORY_LEN
+                if history_count < HISTORY_LEN:
+                    history_count += 1
+                total = 0
+                n = 0
+        await asyncio.sleep_ms(SAMPLE_INTERVAL_MS)  # type: ignore[attr-defined]
+
+
+def history_window(since):
+    """Returns (first, count): the history entries recorded after ticks `since`."""
+    first = (history_head - history_count) % HISTORY_LEN
+    # Entries are in time order, so bisect on ticks_diff (wrap-safe)
+    lo = 0
+    hi = history_count
+    while lo < hi:
+        mid = (lo + hi) >> 1
+        if time.ticks_diff(history_ticks[(first + mid) % HISTORY_LEN], since) > 0:
+            hi = mid
+        else:
+            lo = mid + 1
+    return (first + lo) % HISTORY_LEN, history_count - lo
+
+
+def parse_query(query):
+    """'a=1&b=2' -> {'a': '1', 'b': '2'}"""
+    params = {}
+    for pair in query.split("&"):
+        if pair:
+            key, _, value = pair.partition("=")
+            params[key] = value
+    return params
+
+
+# --- Server-Sent Events ---
+# One sampler task reads the sensor and encodes each sample once; every
+# /events client only keeps the newest undelivered sample, so a slow client
+# skips stale readings instead of holding up the sampler or the audio loop.
+EVENTS_HEAD = (
+    b"HTTP/1.1 200 OK\r\n"
+    b"Content-Type: text/event-stream\r\n"
+    b"Cache-Control: no-cache\r\n"
+    b"Connection: close\r\n\r\n"
+)
+TOO_MANY_CLIENTS = static_reply(HEAD_503_JSON, '{"error": "Too many event clients"}')
+
+
+class EventSubscriber:
+    """Per-client send slot holding at most one pending sample."""
+
+    def __init__(self):
+        self.pending = None
+        self.dropped = 0
+        self.ready = asyncio.Event()
+
+    def offer(self, sample):
+        if self.pending is not None:
+            self.dropped += 1  # client still busy with an older sample
+        self.pending = sample
+        self.ready.set()
+
+
+event_subscribers: list[EventSubscriber] = []
+
+
+async def run_event_sampler():
+    """Samples the sensor for /events clients while any are connected."""
+    while True:
+        if event_subscribers:
+            norm = light_norm(latest_raw)
+            sample = b'data: {"norm": %.2f, "ts": %d}\n\n' % (norm, time.ticks_ms())
+            for subscriber in event_subscribers:
+                subscriber.offer(sample)
+        await asyncio.sleep_ms(EVENT_INTERVAL_MS)  # type: ignore[attr-defined]
+
+
+async def stream_events(writer):
+    """Streams samples to one /events client until it disconnects."""
+    if len(event_subscribers) >= MAX_EVENT_CLIENTS:
+        writer.write(TOO_MANY_CLIENTS[False])
         await writer.drain()
-        writer.close()
-        await writer.wait_closed()
         return
 
-    # Send response
-    writer.write(
-        f"{status_line}Content-type: {content_type}\r\n\r\n".encode("utf-8")
-    )
-    writer.write(response.encode("utf-8"))
-    writer.write(response.encode("utf-8"))
-    await writer.drain()
-    writer.close()
-    await writer.wait_closed()
-    print("Client disconnected")
+    subscriber = EventSubscriber()
+    event_subscribers.append(subscriber)
+    try:
+        writer.write(EVENTS_HEAD)
+        await writer.drain()
+        while True:
+            await subscriber.ready.wait()
+            subscriber.ready.clear()
+            sample = subscriber.pending
+            subscriber.pending = None
+            writer.write(sample)
+            await writer.drain()
+    finally:
+        event_subscribers.remove(subscriber)
+        if subscriber.dropped:
+            print(f"Events client dropped {subscriber.dropped} stale samples")
 
 
 async def main():
     """Main execution loop."""
+    global sequencer_task
     try:
-        ip = connect_to_wifi()
-        print(f"Starting web server on {ip}...")
-        server = await asyncio.start_server(handle_request, "0.0.0.0", 80)
-        print("HTTP server started on port 80")
+        # The network comes up in the background; sound starts right away
+        if DUAL_CORE:
+            start_core1()
+        else:
+            start_engine()
+        asyncio.create_task(run_wifi_supervisor())
+        sequencer_task = asyncio.create_task(run_sequencer())
+        asyncio.create_task(run_sensor_sampler())
+        asyncio.create_task(run_event_sampler())
     except Exception as e:
         print(f"Failed to initialize: {e}")
         return
 
-    # This loop runs the "default" behavior: playing sound based on light
+    # This loop runs the "default" behavior: playing sound based on light.
+    # The PWM is only reprogrammed when the frequency to play changes
+    # (0 = silent, -1 = unknown because the API owned the buzzer).
+    written_freq = -1
+    last_tick = time.ticks_ms()
     while True:
         # Only run this loop if no API note is currently scheduled to play
         now = time.ticks_ms()
+        record_loop_lag(time.ticks_diff(now, last_tick) - LIGHT_LOOP_MS)
+        last_tick = now
+        check_memory()
+        engine_collect_log()
         locked = time.ticks_diff(api_lock_until_ms, now) > 0
 
-        if api_note_task is not None and not api_note_task.done():
-            pass
+        if api_sound_active():
+            if written_freq > 0:
+                # The API took over: silence the light tone, unless the engine
+                # has already started a note of its own
+                state = engine_lock_acquire()
+                if not eng_sounding:
+                    stop_tone()
+                engine_lock_release(state)
+            written_freq = -1
         elif locked:
-            stop_tone()
-        else:
-            light_value = photo_sensor_pin.read_u16()
-            step = light_to_nearest_step(light_value)
-            if step > 0:
-                q_freq = int(step_to_freq(step))
-                buzzer_pin.freq(q_freq)
-                buzzer_pin.duty_u16(DUTY)
-            else:
+            if written_freq != 0:
                 stop_tone()
+                written_freq = 0
+        else:
+            step = light_step
+            freq = step_to_freq(step) if step > 0 else 0
+            if freq != written_freq:
+                if freq:
+                    buzzer_pin.freq(freq)
+                    buzzer_pin.duty_u16(DUTY)
+                else:
+                    stop_tone()
+                written_freq = freq
 
-        await asyncio.sleep_ms(50)  # type: ignore[attr-defined]
+        await asyncio.sleep_ms(LIGHT_LOOP_MS)  # type: ignore[attr-defined]
 
 
 # Run the main event loop
@@ -0,0 +1,394 @@
+# score_compiler.py
+# To be run on a computer (not the Pico)
+# Compiles a song -- a Standard MIDI File, the text notation below, or a
+# conductor-style list of (freq, ms) -- into the exact bytes the conductor
+# sends during playback: a /play_note body, UDP tone datagrams and a /score
+# fragment for every note. Notes are not tied to devices; the conductor's
+# voice allocator picks one per note while playing. Results are cached on
+# disk keyed by a hash of the song and the options, so a long piece compiles
+# once and later runs start immediately with no encoding on the playback path.
+#
+# Text notation (whitespace separated, '#' starts a comment):
+#   tempo=96            beats per minute from here on (default 120)
+#   C4:1  F#4:0.5  Bb3  note name + octave, optional ':beats' (default 1)
+#   440:2               a frequency in Hz instead of a name
+#   C4+E4+G4:2          a chord (notes sounding together)
+#   R:1                 a rest
+#
+# Usage:
+#   python src/score_compiler.py song.mid --tempo 100 --transpose -12
+#   python src/score_compiler.py song.txt
+
+import argparse
+import hashlib
+import json
+import os
+import struct
+from collections import namedtuple
+
+COMPILER_VERSION = 3   # bump when the output format changes, to invalidate caches
+CACHE_DIR = ".score_cache"
+BYTES_FIELDS = ("http", "udp", "udp_at", "score")  # track fields holding bytes
+DEFAULT_TEMPO = 120    # bpm of text scores without a tempo= line
+ARTICULATION = 0.98    # text notes sound for this fraction of their beats
+SONG_GAP = 0.02        # silence after each conductor SONG note, as in live mode
+DRUM_CHANNEL = 9       # General MIDI percussion, which a buzzer can't play
+MAX_NOTE_MS = 65535    # longest note or rest the devices' 16-bit durations hold
+
+# UDP wire format shared with main.py and conductor.py
+UDP_TONE = struct.Struct("<2sBBIHHH")
+UDP_TONE_AT = struct.Struct("<2sBBIHHHI")
+UDP_MAGIC = b"PL"
+UDP_TYPE_TONE = 1
+UDP_TYPE_TONE_AT = 4
+
+# One sounding note of the song, in milliseconds from its start
+Note = namedtuple("Note", ("start_ms", "ms", "freq"))
+
+NOTE_SEMITONES = {"C": 0, "D": 2, "E": 4, "F": 5, "G": 7, "A": 9, "B": 11}
+
+
+def midi_to_freq(key):
+    return 440.0 * 2 ** ((key - 69) / 12)
+
+
+def pitch_to_freq(token, transpose=0):
+    """'C#4', 'Bb3' or '440' -> frequency in Hz, moved by `transpose` semitones."""
+    name = token[:1].upper()
+    if name not in NOTE_SEMITONES:
+        return float(token) * 2 ** (transpose / 12)
+    rest = token[1:]
+    semitone = NOTE_SEMITONES[name]
+    while rest[:1] in ("#", "b"):
+        semitone += 1 if rest[0] == "#" else -1
+        rest = rest[1:]
+    octave = int(rest)
+    return midi_to_freq(12 * (octave + 1) + semitone + transpose)
+
+
+# --- Parsers ---
+
+
+def parse_text(text, tempo=None, transpose=0):
+    """Text notation -> list of Notes. `tempo` overrides any tempo= lines."""
+    notes = []
+    beat_ms = 60000 / (tempo or DEFAULT_TEMPO)
+    t = 0.0
+    for line in text.splitlines():
+        for token in line.split("#", 1)[0].split():
+            if token.lower().startswith("tempo="):
+                if tempo is None:
+                    beat_ms = 60000 / float(token[6:])
+                continue
+            pitches, _, beats = token.partition(":")
+            ms = float(beats or 1) * beat_ms
+            for pitch in pitches.split("+"):
+                if pitch.upper() != "R":
+                    notes.append(Note(t, ms * ARTICULATION, pitch_to_freq(pitch, transpose)))
+            t += ms
+    return notes
+
+
+def read_varlen(data, pos):
+    """MIDI variable-length quantity at data[pos] -> (value, next pos)."""
+    value = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            return value, pos
+
+
+def read_chunks(stream):
+    """Yields (type, data) for each chunk of a Standard MIDI File, one at a time."""
+    while True:
+        header = stream.read(8)
+        if len(header) < 8:
+            return
+        kind, length = struct.unpack(">4sI", header)
+        data = stream.read(length)
+        if len(data) < length:
+            raise ValueError("Truncated MIDI chunk")
+        yield kind, data
+
+
+def parse_track(data, tempos, spans):
+    """Appends a track's tempo changes (tick, us/beat) and notes (tick on, tick off, key)."""
+    pos = 0
+    tick = 0
+    status = 0
+    held = {}  # (channel, key) -> [on ticks], so overlapping repeats pair FIFO
+    while pos < len(data):
+        delta, pos = read_varlen(data, pos)
+        tick += delta
+        byte = data[pos]
+        if byte == 0xFF:
+            kind = data[pos + 1]
+            length, pos = read_varlen(data, pos + 2)
+            if kind == 0x51:
+                tempos.append((tick, int.from_bytes(data[pos:pos + 3], "big")))
+            elif kind == 0x2F:
+                break
+            pos += length
+            continue
+        if byte in (0xF0, 0xF7):
+            length, pos = read_varlen(data, pos + 1)
+            pos += length
+            continue
+        if byte & 0x80:
+            status = byte
+            pos += 1
+        kind = status & 0xF0
+        channel = status & 0x0F
+        if kind in (0xC0, 0xD0):
+            pos += 1
+            continue
+        key = data[pos]
+        velocity = data[pos + 1]
+        pos += 2
+        if channel == DRUM_CHANNEL:
+            continue
+        if kind == 0x90 and velocity:
+            held.setdefault((channel, key), []).append(tick)
+        elif kind == 0x80 or kind == 0x90:
+            starts = held.get((channel, key))
+            if starts:
+                spans.append((starts.pop(0), tick, key))
+
+
+def read_midi(stream, tempo=None, transpose=0):
+    """Standard MIDI File -> list of Notes (all tracks, drums skipped).
+
+    `tempo` rescales the file so its first tempo plays at that many bpm.
+    """
+    chunks = read_chunks(stream)
+    kind, header = next(chunks, (None, b""))
+    if kind != b"MThd" or len(header) < 6:
+        raise ValueError("Not a Standard MIDI File")
+    _, _, division = struct.unpack(">HHH", header[:6])
+    if division & 0x8000:
+        raise ValueError("SMPTE time division is not supported")
+
+    tempos = []
+    spans = []
+    for kind, data in chunks:
+        if kind == b"MTrk":
+            parse_track(data, tempos, spans)
+
+    # Tempo map: tick -> ms at each tempo change (120 bpm until the first one)
+    tempos.sort()
+    if not tempos or tempos[0][0] > 0:
+        tempos.insert(0, (0, 500000))
+    scale = 1.0 if tempo is None else (60e6 / tempos[0][1]) / tempo
+    changes = []
+    ms = 0.0
+    last_tick, last_us = 0, tempos[0][1]
+    for tick, us in tempos:
+        ms += (tick - last_tick) * last_us / division / 1000
+        changes.append((tick, ms, us))
+        last_tick, last_us = tick, us
+
+    def tick_to_ms(tick):
+        lo = 0
+        for i, change in enumerate(changes):
+            if change[0] > tick:
+                break
+            lo = i
+        base_tick, base_ms, us = changes[lo]
+        return (base_ms + (tick - base_tick) * us / division / 1000) * scale
+
+    notes = []
+    for on, off, key in spans:
+        start = tick_to_ms(on)
+        notes.append(Note(start, tick_to_ms(off) - start, midi_to_freq(key + transpose)))
+    notes.sort()
+    return notes
+
+
+def song_to_notes(song, transpose=0):
+    """Conductor SONG [(freq, ms), ...] -> Notes, each followed by a 2% gap."""
+    notes = []
+    t = 0.0
+    for freq, ms in song:
+        notes.append(Note(t, ms, freq * 2 ** (transpose / 12)))
+        t += ms * (1 + SONG_GAP)
+    return notes
+
+
+# --- Tracks ---
+
+
+def melody_line(notes):
+    """Reduces a polyphonic list to one line.
+
+    The highest note wins, and later notes cut earlier ones short.
+    """
+    line = []
+    for note in sorted(notes, key=lambda n: (n.start_ms, -n.freq)):
+        if line and note.start_ms < line[-1].start_ms + line[-1].ms:
+            last = line[-1]
+            if note.start_ms == last.start_ms or note.freq <= last.freq:
+                continue
+            line[-1] = last._replace(ms=note.start_ms - last.start_ms)
+        line.append(note)
+    return line
+
+
+def compile_track(notes):
+    """Pre-serializes every note of a track for every transport, in time order.
+
+    The /play_note bodies stop right after '"seq": ' so playback only appends
+    the seq (and an "at") as bytes; datagrams are built with seq 0, flags 0
+    and at 0 for the sender to patch in place; "score" holds each note's
+    /score entry for score_body().
+    """
+    track = {
+        "offsets": [], "ms": [], "freqs": [],
+        "http": [], "udp": [], "udp_at": [], "score": [],
+    }
+    for note in sorted(notes, key=lambda n: (n.start_ms, -n.freq)):
+        start = int(round(note.start_ms))
+        ms = max(1, min(MAX_NOTE_MS, int(round(note.ms))))
+        freq = int(round(note.freq))
+        track["offsets"].append(start)
+        track["ms"].append(ms)
+        track["freqs"].append(freq)
+        track["http"].append(
+            b'{"frequency": %d, "duration": %.3f, "seq": ' % (freq, ms / 1000)
+        )
+        track["udp"].append(UDP_TONE.pack(UDP_MAGIC, UDP_TYPE_TONE, 0, 0, freq, ms, 0))
+        track["udp_at"].append(
+            UDP_TONE_AT.pack(UDP_MAGIC, UDP_TYPE_TONE_AT, 0, 0, freq, ms, 0, 0)
+        )
+        track["score"].append(b"[%d, %d]" % (freq, ms))
+    return track
+
+
+def score_body(track, indices):
+    """One device's /score upload for the given notes of a track.
+
+    Returns (body prefix ending at '"seq": ', {note index: position in the
+    score}); positions differ from note indices because rests are inserted
+    (split into MAX_NOTE_MS pieces) and a note that overlaps the next one is
+    cut short.
+    """
+    entries = []
+    positions = {}
+    t = 0
+    for i, k in enumerate(indices):
+        start = track["offsets"][k]
+        while start > t:
+            rest = min(start - t, MAX_NOTE_MS)
+            entries.append(b"[0, %d]" % rest)
+            t += rest
+        positions[k] = len(entries)
+        end = start + track["ms"][k]
+        if i + 1 < len(indices) and end > track["offsets"][indices[i + 1]]:
+            end = track["offsets"][indices[i + 1]]
+            entries.append(b"[%d, %d]" % (track["freqs"][k], end - start))
+        else:
+            entries.append(track["score"][k])
+        t = max(t, end)
+    return b'{"notes": [' + b", ".join(entries) + b'], "seq": ', positions
+
+
+def polyphony(notes):
+    """Most notes sounding at once."""
+    edges = sorted([(n.start_ms, 1) for n in notes] + [(n.start_ms + n.ms, -1) for n in notes])
+    most = sounding = 0
+    for _, change in edges:
+        sounding += change
+        most = max(most, sounding)
+    return most
+
+
+# --- Compiler ---
+
+
+def cache_key(source, tempo, transpose):
+    digest = hashlib.sha256()
+    digest.update(repr((COMPILER_VERSION, tempo, transpose)).encode("utf-8"))
+    digest.update(source)
+    return digest.hexdigest()
+
+
+def cache_dump(compiled, f):
+    """Writes a compiled score as JSON, with its byte payloads in hex."""
+    tracks = {
+        name: {field: [v.hex() if isinstance(v, bytes) else v for v in values]
+               for field, values in track.items()}
+        for name, track in compiled["tracks"].items()
+    }
+    json.dump(dict(compiled, tracks=tracks), f)
+
+
+def cache_load(f):
+    """Reads a cache_dump() file back; being plain data, it can't run code."""
+    compiled = json.load(f)
+    for track in compiled["tracks"].values():
+        for field in BYTES_FIELDS:
+            track[field] = [bytes.fromhex(v) for v in track[field]]
+    return compiled
+
+
+def compile_score(source, tempo=None, transpose=0, cache_dir=CACHE_DIR):
+    """Compiles a song, reusing the on-disk cache.
+
+    `source` is a path to a .mid/.midi or text file, or a conductor SONG list.
+    Returns {"key", "duration_ms", "notes", "polyphony", "tracks"}, where
+    tracks["all"] holds every note and tracks["melody"] the single line a
+    unison fleet plays.
+    """
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            data = f.read()
+        is_midi = data[:4] == b"MThd"
+    else:
+        data = repr(list(source)).encode("utf-8")
+        is_midi = False
+    key = cache_key(data, tempo, transpose)
+    path = os.path.join(cache_dir, key + ".json") if cache_dir else None
+    if path and os.path.exists(path):
+        try:
+            with open(path, "r") as f:
+                return cache_load(f)
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            print(f"Ignoring unreadable cache entry {path}: {e}")
+
+    if not isinstance(source, str):
+        notes = song_to_notes(source, transpose)
+    elif is_midi:
+        with open(source, "rb") as f:
+            notes = read_midi(f, tempo, transpose)
+    else:
+        notes = parse_text(data.decode("utf-8"), tempo, transpose)
+
+    compiled = {
+        "key": key,
+        "duration_ms": int(max((n.start_ms + n.ms for n in notes), default=0)),
+        "notes": len(notes),
+        "polyphony": polyphony(notes),
+        "tracks": {"all": compile_track(notes), "melody": compile_track(melody_line(notes))},
+    }
+    if path:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            cache_dump(compiled, f)
+        os.replace(tmp, path)
+    return compiled
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile a song for the conductor")
+    parser.add_argument("song", help="Standard MIDI File or text score")
+    parser.add_argument("--tempo", type=float, default=None, help="tempo in bpm")
+    parser.add_argument("--transpose", type=int, default=0, help="semitones up (or down)")
+    parser.add_argument("--cache-dir", default=CACHE_DIR, help="compiled score cache")
+    args = parser.parse_args()
+
+    compiled = compile_score(args.song, args.tempo, args.transpose, args.cache_dir)
+    print(f"{args.song}: {compiled['notes']} notes, up to {compiled['polyphony']} at once, "
+          f"{compiled['duration_ms'] / 1000:.1f} s (cache key {compiled['key'][:12]})")
+    print(f"  melody line: {len(compiled['tracks']['melody']['offsets'])} notes")
@@ -0,0 +1,391 @@
+# virtual_pico.py
+# To be run on a computer (not the Pico)
+# A CPython stand-in for the MicroPython runtime, so main.py boots unchanged on
+# Linux/macOS for load tests and regression checks. It provides fake `machine`
+# and `network` modules (with machine.Timer callbacks on a thread), the
+# MicroPython-only time/asyncio/json helpers, and records every PWM change
+# with a timestamp.
+#
+# Usage:
+#   python src/virtual_pico.py --port 8080 --udp-port 5005
+#
+# From Python:
+#   pico = virtual_pico.load_firmware(http_port=8080)
+#   asyncio.run(pico.main())
+#   pico.buzzer_pin.events  ->  [PWMEvent(t_ms, kind, value), ...]
+
+import argparse
+import asyncio
+import gc
+import importlib.util
+import json
+import os
+import sys
+import threading
+import time
+import types
+from collections import namedtuple
+
+FIRMWARE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+
+TICKS_PERIOD = 1 << 30  # MicroPython time.ticks_ms() wraps here on the Pico
+TICKS_MAX = TICKS_PERIOD - 1
+TICKS_HALF = TICKS_PERIOD // 2
+
+# Added to every ticks_* reading, to emulate a board whose clock started at
+# some other moment (e.g. for clock-sync tests).
+tick_offset_ms = 0
+
+PWMEvent = namedtuple("PWMEvent", ("t_ms", "kind", "value"))
+
+
+def now_ms():
+    """Host clock used for PWM event timestamps, in float milliseconds."""
+    return time.monotonic() * 1000.0
+
+
+# --- time shims ---
+
+
+def ticks_ms():
+    return (int(now_ms()) + tick_offset_ms) & TICKS_MAX
+
+
+def ticks_us():
+    return (int(time.monotonic() * 1_000_000) + tick_offset_ms * 1000) & TICKS_MAX
+
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) & TICKS_MAX
+
+
+def ticks_diff(ticks1, ticks2):
+    """Signed ticks1 - ticks2, correct across the wrap like MicroPython's."""
+    return ((ticks1 - ticks2 + TICKS_HALF) & TICKS_MAX) - TICKS_HALF
+
+
+def sleep_ms(ms):
+    time.sleep(max(0, ms) / 1000)
+
+
+def sleep_us(us):
+    time.sleep(max(0, us) / 1_000_000)
+
+
+async def asyncio_sleep_ms(ms):
+    await asyncio.sleep(max(0, ms) / 1000)
+
+
+async def stream_readinto(reader, buf):
+    """MicroPython's Stream.readinto(): fills what has arrived, 0 at EOF."""
+    data = await reader.read(len(buf))
+    buf[:len(data)] = data
+    return len(data)
+
+
+# --- json / micropython ---
+
+
+def json_loads(text):
+    """MicroPython's json.loads() takes any buffer, including a memoryview."""
+    if isinstance(text, memoryview):
+        text = bytes(text)
+    return json.loads(text)
+
+
+def emitter(func):
+    """@micropython.native / @micropython.viper: plain bytecode on CPython."""
+    return func
+
+
+# --- machine ---
+
+
+class Pin:
+    IN = 0
+    OUT = 1
+
+    def __init__(self, pin_id, mode=None, *args, **kwargs):
+        self.pin_id = pin_id
+        self.mode = mode
+        self._value = 0
+
+    def value(self, v=None):
+        if v is None:
+            return self._value
+        self._value = int(bool(v))
+
+    def on(self):
+        self._value = 1
+
+    def off(self):
+        self._value = 0
+
+
+class ADC:
+    """Returns `value` from read_u16(); `value` may also be a callable."""
+
+    default_value = 40000
+
+    def __init__(self, pin):
+        self.pin = pin
+        self.value = ADC.default_value
+
+    def read_u16(self):
+        value = self.value() if callable(self.value) else self.value
+        return max(0, min(65535, int(value)))
+
+
+class PWM:
+    """Records every freq/duty change as a PWMEvent in self.events."""
+
+    def __init__(self, pin, *args, **kwargs):
+        self.pin = pin
+        self._freq = 0
+        self._duty = 0
+        self.events = []
+
+    def freq(self, value=None):
+        if value is None:
+            return self._freq
+        self._freq = int(value)
+        self.events.append(PWMEvent(now_ms(), "freq", self._freq))
+
+    def duty_u16(self, value=None):
+        if value is None:
+            return self._duty
+        self._duty = int(value)
+        self.events.append(PWMEvent(now_ms(), "duty", self._duty))
+
+    def deinit(self):
+        self.duty_u16(0)
+
+    def sounding(self):
+        """Replays the events into [(start_ms, end_ms, freq, duty)] audible spans.
+
+        A span still sounding at the end has end_ms None.
+        """
+        spans = []
+        freq = 0
+        duty = 0
+        start = None
+        for t_ms, kind, value in self.events:
+            if kind == "freq":
+                new_freq, new_duty = value, duty
+            else:
+                new_freq, new_duty = freq, value
+            if (new_freq, new_duty) == (freq, duty):
+                continue
+            if start is not None:
+                spans.append((start, t_ms, freq, duty))
+                start = None
+            freq, duty = new_freq, new_duty
+            if duty > 0 and freq > 0:
+                start = t_ms
+        if start is not None:
+            spans.append((start, None, freq, duty))
+        return spans
+
+
+# Held while a Timer callback runs; machine.disable_irq() takes it too, as
+# masking interrupts does on the Pico
+irq_lock = threading.RLock()
+
+
+def disable_irq():
+    irq_lock.acquire()
+    return True
+
+
+def enable_irq(state=True):
+    irq_lock.release()
+
+
+class Timer:
+    """Calls `callback(timer)` from a background thread, standing in for an interrupt."""
+
+    ONE_SHOT = 0
+    PERIODIC = 1
+
+    def __init__(self, id=-1, **kwargs):
+        self.running = False
+        if kwargs:
+            self.init(**kwargs)
+
+    def init(self, mode=PERIODIC, freq=None, period=None, tick_hz=1000, callback=None,
+             hard=False):
+        self.deinit()
+        interval = 1.0 / freq if freq else period / tick_hz
+        self.running = True
+
+        def run():
+            deadline = time.monotonic()
+            while self.running:
+                deadline += interval
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    deadline = time.monotonic()  # overran: skip ticks, like a busy core
+                if not self.running:
+                    return
+                with irq_lock:
+                    callback(self)
+                if mode == Timer.ONE_SHOT:
+                    return
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def deinit(self):
+        self.running = False
+
+
+unique_id_bytes = b"\xe6\x61\x41\x04\x03\x25\x8b\x2c"
+
+
+def unique_id():
+    return unique_id_bytes
+
+
+# --- network ---
+
+
+class WLAN:
+    """A station interface that associates instantly, on the loopback address.
+
+    Set `connected = False` to simulate a dropped link, or `refuse = True` to
+    make connect() fail (e.g. to exercise the firmware's reconnect backoff).
+    """
+
+    STAT_GOT_IP = 3
+    STAT_CONNECT_FAIL = -1
+
+    def __init__(self, interface=0):
+        self.interface = interface
+        self._active = False
+        self.connected = False
+        self.refuse = False
+        self.connects = []  # keyword arguments of every connect() call
+        self.address = "127.0.0.1"
+
+    def active(self, state=None):
+        if state is None:
+            return self._active
+        self._active = bool(state)
+
+    def connect(self, ssid=None, password=None, **kwargs):
+        self.ssid = ssid
+        self.connects.append(kwargs)
+        self.connected = not self.refuse
+
+    def disconnect(self):
+        self.connected = False
+
+    def status(self, param=None):
+        if param == "rssi":
+            return -50
+        return WLAN.STAT_GOT_IP if self.connected else WLAN.STAT_CONNECT_FAIL
+
+    def isconnected(self):
+        return self.connected
+
+    def ifconfig(self, config=None):
+        if config is None:
+            return (self.address, "255.255.255.0", "127.0.0.1", "127.0.0.1")
+        if isinstance(config, tuple):
+            self.address = config[0]
+
+    def scan(self):
+        """One access point broadcasting the SSID last connected to."""
+        ssid = getattr(self, "ssid", None) or ""
+        return [(ssid.encode("utf-8"), b"\x02\x00\x00\x00\x00\x01", 6, -50, 3, False)]
+
+    def config(self, *args, **kwargs):
+        if args == ("rssi",):
+            return -50
+        if args == ("bssid",):
+            return b"\x02\x00\x00\x00\x00\x01"
+        if args == ("channel",):
+            return 6
+        return None
+
+
+def install():
+    """Registers the fake modules and MicroPython shims (idempotent)."""
+    machine = types.ModuleType("machine")
+    machine.Pin = Pin
+    machine.ADC = ADC
+    machine.PWM = PWM
+    machine.unique_id = unique_id
+    machine.Timer = Timer
+    machine.disable_irq = disable_irq
+    machine.enable_irq = enable_irq
+    sys.modules["machine"] = machine
+
+    network = types.ModuleType("network")
+    network.STA_IF = 0
+    network.AP_IF = 1
+    network.WLAN = WLAN
+    sys.modules["network"] = network
+
+    micropython = types.ModuleType("micropython")
+    micropython.native = emitter
+    micropython.viper = emitter
+    micropython.const = lambda value: value
+    micropython.alloc_emergency_exception_buf = lambda size: None
+    sys.modules["micropython"] = micropython
+
+    time.ticks_ms = ticks_ms
+    time.ticks_us = ticks_us
+    time.ticks_add = ticks_add
+    time.ticks_diff = ticks_diff
+    time.sleep_ms = sleep_ms
+    time.sleep_us = sleep_us
+    asyncio.sleep_ms = asyncio_sleep_ms
+    asyncio.StreamReader.readinto = stream_readinto
+    # The Pico's heap is ~190 KB; report a plausible split of it
+    gc.mem_free = lambda: 150000
+    gc.mem_alloc = lambda: 40000
+    # Timer threads stand in for interrupts; let them preempt the event loop
+    # about as promptly as an IRQ would
+    sys.setswitchinterval(0.0005)
+
+
+def load_firmware(http_port=8080, udp_port=5005, host="127.0.0.1", quiet=False,
+                  name="virtual_pico_main", path=FIRMWARE):
+    """Imports a fresh copy of main.py bound to a loopback port.
+
+    Each call returns an independent module (own globals, own fake PWM/ADC),
+    so several virtual devices can share one process on different ports.
+    """
+    install()
+    spec = importlib.util.spec_from_file_location(name, path)
+    firmware = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(firmware)
+    firmware.json = types.SimpleNamespace(loads=json_loads, dumps=json.dumps)
+    firmware.BIND_HOST = host
+    firmware.HTTP_PORT = http_port
+    firmware.UDP_PORT = udp_port
+    if quiet:
+        firmware.print = lambda *args, **kwargs: None
+    return firmware
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run main.py on a virtual Pico")
+    parser.add_argument("--port", type=int, default=8080, help="HTTP port (default 8080)")
+    parser.add_argument("--udp-port", type=int, default=5005, help="UDP command port")
+    parser.add_argument("--host", default="127.0.0.1", help="address to bind")
+    parser.add_argument("--adc", type=int, default=ADC.default_value, help="fixed ADC reading")
+    parser.add_argument("--quiet", action="store_true", help="silence firmware prints")
+    parser.add_argument("--dual-core", action="store_true",
+                        help="run the note engine and sampler on a second thread (DUAL_CORE)")
+    args = parser.parse_args()
+
+    ADC.default_value = args.adc
+    pico = load_firmware(args.port, args.udp_port, args.host, args.quiet)
+    pico.DUAL_CORE = args.dual_core
+    try:
+        asyncio.run(pico.main())
+    except KeyboardInterrupt:
+        print("Virtual Pico stopped.")
@@ -0,0 +1,107 @@
+# Boots main.py on a virtual Pico and drives its HTTP server over loopback,
+# so the request path (parser, handlers, note engine) is checked in CI.
+
+import asyncio
+import http.client
+import json
+import socket
+import threading
+import time
+
+import pytest
+
+import virtual_pico
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until(predicate, timeout=3.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+@pytest.fixture(scope="module")
+def pico():
+    """A running virtual Pico in the dark, so the light instrument stays silent."""
+    firmware = virtual_pico.load_firmware(free_port(), free_port(), quiet=True)
+    firmware.photo_sensor_pin.value = 0
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(firmware.main())
+
+    def run():
+        try:
+            loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            pass
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+
+    def accepting():
+        try:
+            socket.create_connection(("127.0.0.1", firmware.HTTP_PORT), timeout=0.1).close()
+            return True
+        except OSError:
+            return False
+
+    assert wait_until(accepting), "HTTP server did not start"
+    yield firmware
+    loop.call_soon_threadsafe(task.cancel)
+    thread.join(timeout=2)
+
+
+@pytest.fixture
+def conn(pico):
+    connection = http.client.HTTPConnection("127.0.0.1", pico.HTTP_PORT, timeout=2)
+    yield connection
+    connection.close()
+
+
+def request(conn, method, path, body=None):
+    conn.request(method, path, body=body, headers={"Content-Type": "application/json"})
+    response = conn.getresponse()
+    return response.status, response.read()
+
+
+def test_keep_alive_get(conn, pico):
+    status, body = request(conn, "GET", "/health")
+    assert status == 200
+    assert json.loads(body)["device_id"] == pico.DEVICE_ID
+    sock = conn.sock
+    status, _ = request(conn, "GET", "/sensor")
+    assert status == 200
+    assert conn.sock is sock  # both requests went over one connection
+
+
+def test_tone_sounds(conn, pico):
+    pico.buzzer_pin.events.clear()
+    status, body = request(conn, "POST", "/tone", json.dumps({"freq": 440, "ms": 100}))
+    assert status == 202
+    assert json.loads(body)["playing"] is True
+
+    def finished():
+        spans = pico.buzzer_pin.sounding()
+        return spans and spans[-1][1] is not None
+
+    assert wait_until(finished)
+    (start, end, freq, duty), = pico.buzzer_pin.sounding()
+    assert freq == 440
+    assert duty == pico.duty_to_u16(0.5)
+    assert 80 <= end - start <= 150
+
+
+@pytest.mark.parametrize("body", [b"[]", b"[1]", b"5", b'{"freq": "abc"}', b'{"ms": -5}'])
+def test_tone_rejects_bad_body(conn, body):
+    status, _ = request(conn, "POST", "/tone", body)
+    assert status == 400
+    # The connection survives the rejected request
+    status, _ = request(conn, "GET", "/health")
+    assert status == 200